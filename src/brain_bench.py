@@ -0,0 +1,271 @@
+"""Microbenchmarks of germ code on a corpus of genomes harvested from saved tanks"""
+
+import argparse
+import json
+import os
+import sys
+from random import Random
+from time import perf_counter_ns, strftime
+
+from germ_brain import GermBrain, SensorState, intern_code, flatten
+from germ_tank import GermTank, TankConfig, GermView, STARTING_CODE
+from tank_checkpoint import load_checkpoint
+
+# corpus run by default, checked in alongside this module
+BRAIN_CORPUS = os.path.join(os.path.dirname(__file__), 'brain_corpus.json')
+CORPUS_GENOMES = 100                # most common genomes harvest keeps
+CORPUS_MEMORIES = 3                 # distinct memory states harvest keeps for each genome
+BENCH_SEED = 1                      # seed of the views, sensor states and mutations
+VIEW_DENSITIES = [0.0, 0.05, 0.2, 0.5]  # fractions of the cells in view that are occupied,
+                                        # alternately by germs and food
+RUNS_PER_STATE = 100                # runs timed per genome, memory state and view density
+MUTATIONS_PER_GENOME = 50           # mutations and flattens timed per genome
+LENGTH_BUCKETS = [8, 16, 32, 64, 128]   # genome lengths that mutation costs are grouped by
+
+def harvest(tank, genomes=CORPUS_GENOMES, memories=CORPUS_MEMORIES):
+    """Returns a corpus of the distinct genomes in a tank, as run_benchmarks takes.
+
+    Params:
+     - tank (GermTank): The tank to harvest
+     - genomes (int): Number of genomes to keep, most common first
+     - memories (int): Number of distinct memory states to keep for each genome
+
+    Returns (dict): Keys are:
+     - frames_elapsed (int): The age of the tank
+     - genomes (list of dict): Each has the code, the number of germs running it and a list
+        of their memories, as in GermBrain.to_dict
+    """
+
+    found = {}
+    for obj in tank.objects.values():
+        if obj.brain:
+            d = obj.brain.to_dict()
+            entry = found.setdefault(repr(d['code']),
+                                     {'code':d['code'], 'germs':0, 'memories':[]})
+            entry['germs'] += 1
+            if len(entry['memories']) < memories and d['memory'] not in entry['memories']:
+                entry['memories'].append(dict(d['memory']))
+    # sorted is stable, so genomes as common as each other stay in the order germs take turns
+    ordered = sorted(found.values(), key=lambda entry: -entry['germs'])
+    return {'frames_elapsed':tank.frames_elapsed, 'genomes':ordered[:genomes]}
+
+def load_tank(path):
+    """Returns the tank saved at path, either as json or as a checkpoint"""
+
+    if path.endswith('.json'):
+        with open(path) as fileobj:
+            return GermTank(fileobj.read())
+    return GermTank(snapshot=load_checkpoint(path))
+
+def make_view(density, rng):
+    """Returns a GermView from the centre of a tank just big enough to hold it, with a fraction
+    density of the cells in view occupied
+    """
+
+    config = TankConfig()
+    size = config.germ_view_dist * 2 + 1
+    tank = GermTank(config=TankConfig(tank_width=size, tank_height=size), seed=rng.getrandbits(64))
+    for obj in list(tank.objects.values()):
+        tank.kill_germ(obj)
+    centre = size // 2
+    brain = GermBrain(STARTING_CODE, 0)
+    tank.add_object(tank.add_germ(centre, centre, brain))
+    cells = [(centre + dx, centre + dy) for dx, dy in config.view_locs]
+    for i, (x, y) in enumerate(rng.sample(cells, int(len(cells) * density))):
+        tank.add_object(tank.add_germ(x, y, brain if i % 2 else None))
+    return GermView(tank, centre, centre)
+
+def expressions(code):
+    """Returns (list): Every expression in code, i.e. every argument but a mark id"""
+
+    out = []
+    for cmd in code:
+        if cmd[0] == 'if':
+            out.append(cmd[1])
+        elif cmd[0] != 'mrk':
+            out.extend(cmd[1:])
+    return out
+
+def benchmark_runs(corpus, densities=VIEW_DENSITIES, runs=RUNS_PER_STATE, seed=BENCH_SEED):
+    """Times GermBrain.run and GermBrain.resolve_value on every genome in a corpus.
+
+    Each memory state of each genome is run against the same synthetic sensor states, with
+    views of each density. Code is compiled before timing starts, as a tank compiles it once.
+
+    Returns (dict): For each density, keyed by str(density):
+     - runs (int): Runs timed
+     - ns_per_run (float): Average time of GermBrain.run
+     - instructions_per_run (float): Average commands executed per run
+     - instructions_per_second (float): Commands executed per second of running
+     - halt_rate (float): Fraction of runs halted by the execution limit
+     - errors (int): Runs that raised an exception
+     - ns_per_expression (float): Average time of GermBrain.resolve_value on the expressions
+        in the code, which is how run_counted evaluates them
+    """
+
+    rng = Random(seed)
+    senses = [(rng.randrange(101), rng.randrange(101), rng.randrange(6), rng.choice([0, 0, 0, 5]),
+               rng.random() < 0.8) for i in range(runs)]
+    results = {}
+    for density in densities:
+        view = make_view(density, rng)
+        sensors = SensorState(view=view)
+        elapsed_ns = executed = halts = errors = count = 0
+        resolve_ns = evaluated = 0
+        for entry in corpus['genomes']:
+            code = entry['code']
+            # compiles the code, which stays compiled while this brain keeps its genome interned
+            compiled = GermBrain(code, 0)
+            try:
+                compiled.run(sensors)
+            except RuntimeError:
+                pass
+            for memory in entry['memories'] or [{}]:
+                brain = GermBrain.from_dict({'code':code, 'memory':memory})
+                for energy, brightness, stamina, pain, success in senses:
+                    sensors.energy = energy
+                    sensors.brightness = brightness
+                    sensors.stamina = stamina
+                    sensors.pain = pain
+                    sensors.success = success
+                    view.reset(view.x, view.y)
+                    start = perf_counter_ns()
+                    try:
+                        request = brain.run(sensors)
+                    except RuntimeError:
+                        # malformed code, which would stop a tank
+                        request = None
+                        errors += 1
+                    elapsed_ns += perf_counter_ns() - start
+                    executed += brain.executed
+                    count += 1
+                    halts += request is not None and request.action == 'halt'
+            for expr in expressions(code):
+                view.reset(view.x, view.y)
+                start = perf_counter_ns()
+                try:
+                    brain.resolve_value(expr)
+                except Exception:
+                    pass
+                resolve_ns += perf_counter_ns() - start
+                evaluated += 1
+        results[str(density)] = {
+            'runs':count,
+            'ns_per_run':elapsed_ns / max(count, 1),
+            'instructions_per_run':executed / max(count, 1),
+            'instructions_per_second':executed * 1000000000.0 / max(elapsed_ns, 1),
+            'halt_rate':halts / max(count, 1),
+            'errors':errors,
+            'ns_per_expression':resolve_ns / max(evaluated, 1)}
+    return results
+
+def length_bucket(length):
+    """Returns (str): The LENGTH_BUCKETS range a genome length falls in, e.g. '16-31'"""
+
+    low = 0
+    for high in LENGTH_BUCKETS:
+        if length < high:
+            return f'{low}-{high - 1}'
+        low = high
+    return f'{low}+'
+
+def benchmark_mutations(corpus, mutations=MUTATIONS_PER_GENOME, seed=BENCH_SEED):
+    """Times GermBrain.mutate and flatten on every genome in a corpus, by genome length.
+
+    Each mutation is of a new brain running the genome, as at a birth, so it includes taking
+    a private copy of the code. Flattening is of every command in the genome.
+
+    Returns (dict): For each length bucket that has genomes, shortest first:
+     - genomes (int): Genomes in the bucket
+     - commands (float): Average length of those genomes
+     - ns_per_mutate (float): Average time of one mutation
+     - ns_per_flatten (float): Average time of flattening a whole genome
+    """
+
+    rng = Random(seed)
+    buckets = {}
+    for entry in corpus['genomes']:
+        code = entry['code']
+        genome = intern_code(code)
+        mutate_ns = 0
+        for i in range(mutations):
+            brain = GermBrain(genome, 0, None, rng)
+            start = perf_counter_ns()
+            brain.mutate()
+            mutate_ns += perf_counter_ns() - start
+        start = perf_counter_ns()
+        for i in range(mutations):
+            for address, cmd in enumerate(code):
+                flatten(cmd, [address])
+        flatten_ns = perf_counter_ns() - start
+        bucket = buckets.setdefault(length_bucket(len(code)),
+                                    {'genomes':0, 'commands':0, 'mutate_ns':0, 'flatten_ns':0})
+        bucket['genomes'] += 1
+        bucket['commands'] += len(code)
+        bucket['mutate_ns'] += mutate_ns
+        bucket['flatten_ns'] += flatten_ns
+    order = [length_bucket(length) for length in [0] + LENGTH_BUCKETS]
+    return {name:{'genomes':bucket['genomes'],
+                  'commands':bucket['commands'] / bucket['genomes'],
+                  'ns_per_mutate':bucket['mutate_ns'] / bucket['genomes'] / mutations,
+                  'ns_per_flatten':bucket['flatten_ns'] / bucket['genomes'] / mutations}
+            for name, bucket in sorted(buckets.items(), key=lambda item: order.index(item[0]))}
+
+def run_benchmarks(corpus, runs=RUNS_PER_STATE, mutations=MUTATIONS_PER_GENOME):
+    """Returns (dict): The results of benchmark_runs as 'runs' and of benchmark_mutations as
+    'mutations', with the settings they ran with
+    """
+
+    return {'time':strftime('%Y-%m-%dT%H:%M:%S'),
+            'genomes':len(corpus['genomes']),
+            'seed':BENCH_SEED,
+            'runs_per_state':runs,
+            'mutations_per_genome':mutations,
+            'runs':benchmark_runs(corpus, runs=runs),
+            'mutations':benchmark_mutations(corpus, mutations)}
+
+def main(args):
+    parser = argparse.ArgumentParser(description=__doc__)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    harvest_parser = subparsers.add_parser('harvest', help='build a corpus from a saved tank')
+    harvest_parser.add_argument('save', help='tank saved as json, or a checkpoint')
+    harvest_parser.add_argument('-o', '--output', default=BRAIN_CORPUS,
+                                help='file to write the corpus to')
+    harvest_parser.add_argument('-g', '--genomes', type=int, default=CORPUS_GENOMES,
+                                help='most common genomes to keep')
+    run_parser = subparsers.add_parser('run', help='benchmark germ code on a corpus')
+    run_parser.add_argument('corpus', nargs='?', default=BRAIN_CORPUS, help='corpus to run')
+    run_parser.add_argument('-o', '--output', help='file to write results to as json, '
+                            'rather than stdout')
+    run_parser.add_argument('-r', '--runs', type=int, default=RUNS_PER_STATE,
+                            help='runs timed per genome, memory state and view density')
+    run_parser.add_argument('-m', '--mutations', type=int, default=MUTATIONS_PER_GENOME,
+                            help='mutations timed per genome')
+    options = parser.parse_args(args[1:])
+
+    if options.command == 'harvest':
+        corpus = harvest(load_tank(options.save), options.genomes)
+        with open(options.output, 'w') as fileobj:
+            json.dump(corpus, fileobj, separators=(',', ':'))
+        print(f'{len(corpus["genomes"])} genomes written to {options.output}')
+        return 0
+
+    with open(options.corpus) as fileobj:
+        results = run_benchmarks(json.load(fileobj), options.runs, options.mutations)
+    for density, result in results['runs'].items():
+        print(f'density {density}: {result["ns_per_run"]:.0f} ns per run, '
+              f'{result["instructions_per_second"]:.0f} instructions/s, '
+              f'halt rate {result["halt_rate"]:.3f}, '
+              f'{result["ns_per_expression"]:.0f} ns per expression', file=sys.stderr)
+    for bucket, result in results['mutations'].items():
+        print(f'length {bucket}: {result["ns_per_mutate"]:.0f} ns per mutate, '
+              f'{result["ns_per_flatten"]:.0f} ns per flatten', file=sys.stderr)
+    if options.output:
+        with open(options.output, 'w') as fileobj:
+            json.dump(results, fileobj, indent=1)
+    else:
+        print(json.dumps(results, indent=1))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
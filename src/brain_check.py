@@ -0,0 +1,277 @@
+"""Checks that germ code runs the same compiled as it does interpreted plainly from its source"""
+
+import argparse
+import json
+import sys
+from random import Random
+
+from germ_brain import (GermBrain, RunCounts, SensorState, MEMORY_SIZE, DIVIDE_BY_ZERO,
+                        fold_expr)
+from germ_tank import TankConfig, STARTING_CODE
+from brain_bench import BRAIN_CORPUS, expressions, make_view
+
+CHECK_SEED = 1                  # seed of the programs, mutations, views and sensor states
+CHECK_MUTATED = 3000            # mutated corpus genomes checked
+CHECK_RANDOM = 4000             # random programs checked
+MAX_MUTATIONS = 8               # most mutations applied to a corpus genome
+MAX_LENGTH = 40                 # most commands added to STARTING_CODE for a random program
+STATES_PER_PROGRAM = 4          # sensor states each program is run with
+CHECK_EXECUTIONS = 2000         # execution limit programs run with, lower than a tank's so
+                                # halting programs check quickly
+VIEW_DENSITIES = [0.0, 0.2]     # fractions of the cells in view that are occupied
+ENDING_COMMANDS = ['mv', 'bir', 'att', 'ret']   # commands that end a germ's run
+REPORT_LIMIT = 10               # mismatches printed in full
+
+def reference_value(brain, expr):
+    """Evaluates expr the way the original interpreter did, with no compiling or folding"""
+
+    if type(expr) == int:
+        return expr
+    elif type(expr) == str:
+        if expr in ('energy', 'brightness', 'stamina', 'pain', 'success'):
+            return int(getattr(brain.state, expr))
+        raise KeyError(f'"{expr}" is not a valid special value"')
+    elif type(expr) == list:
+        oper = expr[0]
+        if oper == '+':
+            return reference_value(brain, expr[1]) + reference_value(brain, expr[2])
+        elif oper == '-':
+            return reference_value(brain, expr[1]) - reference_value(brain, expr[2])
+        elif oper == '*':
+            return reference_value(brain, expr[1]) * reference_value(brain, expr[2])
+        elif oper == '/':
+            try:
+                return int(reference_value(brain, expr[1]) / reference_value(brain, expr[2]))
+            except ZeroDivisionError:
+                return DIVIDE_BY_ZERO
+        elif oper == '&':
+            return reference_value(brain, expr[1]) and reference_value(brain, expr[2])
+        elif oper == '|':
+            return reference_value(brain, expr[1]) or reference_value(brain, expr[2])
+        elif oper == '!':
+            return not reference_value(brain, expr[1])
+        elif oper == '<':
+            return reference_value(brain, expr[1]) < reference_value(brain, expr[2])
+        elif oper == '>':
+            return reference_value(brain, expr[1]) > reference_value(brain, expr[2])
+        elif oper == '==':
+            return reference_value(brain, expr[1]) == reference_value(brain, expr[2])
+        elif oper == '!=':
+            return reference_value(brain, expr[1]) != reference_value(brain, expr[2])
+        elif oper == 'm':
+            return brain.memory.get(reference_value(brain, expr[1]) % MEMORY_SIZE, 0)
+        elif oper in ('gix', 'giy', 'fix', 'fiy'):
+            index = reference_value(brain, expr[1])
+            view = brain.state.view
+            loc = view.germ(index) if oper[0] == 'g' else view.food_particle(index)
+            return (loc[0] if oper[2] == 'x' else loc[1]) if loc else 0
+        raise KeyError(f'"{expr}" is not a valid operator')
+    raise TypeError(f'"{repr(expr)}" is not a valid expr type ({type(expr)})')
+
+def reference_run(brain, state):
+    """Runs a brain's code the way the original interpreter did, one source command at a time.
+
+    Returns (tuple): The request, as (action, x, y, burst, power), and the commands executed
+    """
+
+    code = brain.code
+    head = ax = ay = power = executed = 0
+    burst = False
+    brain.state = state
+    try:
+        while executed < brain.max_executions:
+            executed += 1
+            if head >= len(code):
+                return (None, 0, 0, False, 0), executed
+            cmd = code[head][0]
+            if cmd == 'set':
+                register = reference_value(brain, code[head][1]) % MEMORY_SIZE
+                value = reference_value(brain, code[head][2])
+                if value:
+                    brain.memory[register] = value
+                else:
+                    brain.memory.pop(register, None)
+            elif cmd == 'if':
+                if not reference_value(brain, code[head][1]):
+                    dest = code[head][2]
+                    for i, elem in enumerate(code):
+                        if elem[0] == 'mrk' and elem[1] == dest:
+                            head = i
+                            break
+                    else:
+                        raise KeyError(f'Mark "{dest}" not found')
+            elif cmd == 'mrk':
+                pass
+            elif cmd == 'ax':
+                new_x = reference_value(brain, code[head][1])
+                ax = -1 if new_x < 0 else 1 if new_x > 0 else 0
+            elif cmd == 'ay':
+                new_y = reference_value(brain, code[head][1])
+                ay = -1 if new_y < 0 else 1 if new_y > 0 else 0
+            elif cmd == 'bst':
+                burst = reference_value(brain, code[head][1]) == True
+            elif cmd == 'pwr':
+                power = reference_value(brain, code[head][1]) % 6
+            elif cmd == 'mv':
+                return ('move', ax, ay, burst, 0), executed
+            elif cmd == 'bir':
+                return ('birth', ax, ay, burst, 0), executed
+            elif cmd == 'att':
+                return ('attack', ax, ay, burst, power), executed
+            elif cmd == 'ret':
+                return (None, 0, 0, False, 0), executed
+            else:
+                raise KeyError(f'"{cmd}" is not a valid command')
+            head += 1
+        return ('halt', 0, 0, False, 0), executed
+    except Exception as err:
+        msg = f'Exception raised from germ code (line {head})\n'
+        for i, e in enumerate(code):
+            msg += f'{i}: {e}\n'
+        raise RuntimeError(msg) from err
+
+def outcome(func, *args):
+    """Returns (tuple): What calling func(*args) returned, or the exception it raised, in a form
+    that compares equal between interpreters
+    """
+
+    try:
+        return 'ok', func(*args)
+    except RuntimeError as err:
+        # raised by a run, from what the germ code raised
+        cause = err.__cause__
+        return 'raised', str(err), type(cause).__name__, str(cause)
+    except Exception as err:
+        return 'raised', type(err).__name__, str(err)
+
+def request(state):
+    """Returns (tuple): The request a run set on state, as reference_run returns it"""
+
+    return state.action, state.x, state.y, state.burst, state.power
+
+def check_program(code, memory, senses, views, config):
+    """Returns (list of str): How run, run_counted, resolve_value and compiled expressions
+    differ from the reference interpreter on code, for every sensor state and view
+    """
+
+    mismatches = []
+    reference = GermBrain.from_dict({'code':code, 'memory':memory}, config)
+    runs = {'run':lambda brain, state: brain.run(state),
+            'run_counted':lambda brain, state: brain.run(state, RunCounts())}
+    brains = {name:GermBrain.from_dict({'code':code, 'memory':memory}, config) for name in runs}
+    for view in views:
+        for energy, brightness, stamina, pain, success in senses:
+            view.reset(view.x, view.y)
+            state = SensorState(energy, brightness, stamina, pain, view, success)
+            expected = outcome(reference_run, reference, state)
+            for name, run in runs.items():
+                brain = brains[name]
+                view.reset(view.x, view.y)
+                state = SensorState(energy, brightness, stamina, pain, view, success)
+                result = outcome(lambda: (request(run(brain, state)), brain.executed))
+                wanted = expected
+                if name == 'run' and result[0] == expected[0] == 'ok' and \
+                        result[1][0][0] == expected[1][0][0] == 'halt':
+                    # run may halt a germ stuck in a loop before it reaches the limit
+                    result = wanted = 'ok', expected[1][0]
+                if result != wanted or brain.memory != reference.memory:
+                    mismatches.append(f'{name} gave {result} and memory {brain.memory}, '
+                                      f'expected {wanted} and memory {reference.memory}; '
+                                      f'code {code}')
+                    # the memories have diverged, so later runs would only repeat the mismatch
+                    return mismatches
+            # every expression is evaluated in the state the runs left behind
+            for expr in expressions(code):
+                view.reset(view.x, view.y)
+                expected = outcome(reference_value, reference, expr)
+                for name, func, arg in [('resolve_value', reference.resolve_value, expr),
+                                        ('compiled', fold_expr(expr)[0], reference)]:
+                    view.reset(view.x, view.y)
+                    result = outcome(func, arg)
+                    if result != expected:
+                        mismatches.append(f'{name} gave {result}, expected {expected}; '
+                                          f'expression {expr}')
+    return mismatches
+
+def random_program(rng, config):
+    """Returns (list of lists): STARTING_CODE with random commands inserted into it.
+
+    Half the programs leave out the commands that end a run, so that most of them loop until
+    they halt. Half have a loop counting a register up to a limit, which only some of them
+    increment, and a few lose a mark, so that an if can fail to find it.
+    """
+
+    brain = GermBrain(STARTING_CODE, 0, config, rng)
+    ending = rng.random() < 0.5
+    for i in range(rng.randrange(MAX_LENGTH)):
+        command = brain.rand_command()
+        if ending or command[0] not in ENDING_COMMANDS:
+            brain.insert_command(rng.randrange(len(brain.code) + 1), command)
+    code = brain.code[:]
+    if rng.random() < 0.5:
+        register = rng.randrange(MEMORY_SIZE)
+        # a mark id rand_command won't have used
+        mark = f'm{len(code) + 1000}'
+        body = [['ax', brain.rand_value()], ['pwr', brain.rand_value()]]
+        if rng.random() < 0.5:
+            body.append(['set', register, ['+', ['m', register], rng.randrange(1, 6)]])
+        rng.shuffle(body)
+        start = rng.randrange(len(code) + 1)
+        code[start:start] = ([['mrk', mark]] + body
+                             + [['if', ['>', ['m', register], rng.randrange(50)], mark]])
+    marks = [i for i, cmd in enumerate(code) if cmd[0] == 'mrk']
+    if marks and rng.random() < 0.05:
+        del code[rng.choice(marks)]
+    return code
+
+def run_checks(corpus, mutated=CHECK_MUTATED, random=CHECK_RANDOM, seed=CHECK_SEED):
+    """Checks mutated corpus genomes and random programs against the reference interpreter.
+
+    Returns (dict): Keys are:
+     - programs (int): Programs checked
+     - mismatches (list of str): Every difference found from the reference interpreter
+    """
+
+    rng = Random(seed)
+    config = TankConfig(max_executions=CHECK_EXECUTIONS)
+    views = [make_view(density, rng) for density in VIEW_DENSITIES]
+    mismatches = []
+    genomes = corpus['genomes']
+    programs = []
+    for i in range(mutated):
+        entry = genomes[i % len(genomes)]
+        brain = GermBrain(entry['code'], rng.randrange(MAX_MUTATIONS + 1), config, rng)
+        memory = rng.choice(entry['memories'] or [{}])
+        programs.append((brain.code, memory))
+    for i in range(random):
+        memory = {rng.randrange(MEMORY_SIZE):rng.randrange(-500, 500) for i in range(3)}
+        programs.append((random_program(rng, config), memory))
+    for code, memory in programs:
+        senses = [(rng.randrange(101), rng.randrange(101), rng.randrange(6),
+                   rng.choice([0, 0, 0, 5]), rng.random() < 0.8)
+                  for i in range(STATES_PER_PROGRAM)]
+        mismatches += check_program(code, memory, senses, views, config)
+    return {'programs':len(programs), 'mismatches':mismatches}
+
+def main(args):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('corpus', nargs='?', default=BRAIN_CORPUS,
+                        help='corpus whose genomes are mutated and checked')
+    parser.add_argument('-m', '--mutated', type=int, default=CHECK_MUTATED,
+                        help='mutated corpus genomes to check')
+    parser.add_argument('-r', '--random', type=int, default=CHECK_RANDOM,
+                        help='random programs to check')
+    parser.add_argument('-s', '--seed', type=int, default=CHECK_SEED,
+                        help='seed of the programs and sensor states')
+    options = parser.parse_args(args[1:])
+
+    with open(options.corpus) as fileobj:
+        results = run_checks(json.load(fileobj), options.mutated, options.random, options.seed)
+    for mismatch in results['mismatches'][:REPORT_LIMIT]:
+        print(mismatch)
+    print(f'{results["programs"]} programs checked, '
+          f'{len(results["mismatches"])} mismatches', file=sys.stderr)
+    return 1 if results['mismatches'] else 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -1,44 +1,86 @@
 """Classes and methods related to germ code"""
 
 import sys
-from copy import deepcopy
-from random import randrange, choice
+from bisect import bisect_right
+from itertools import accumulate, chain
+from operator import attrgetter
+import random
+from weakref import WeakValueDictionary
 
 MAX_EXECUTIONS = 10000          # Commands to execute before halting; stops infinite loops
 MEMORY_SIZE = 100               # Variables germs can store in memory
 DIVIDE_BY_ZERO = 1000000        # What any number divided by zero should equal in germ code
+SITE_BLOCK = 64                 # Commands per block of a SiteIndex
+
+# special values that can be read from the germ state
+SPECIAL_VALUES = {'energy', 'brightness', 'stamina', 'pain', 'success'}
+# number of arguments taken by each operator
+OPERATOR_ARGS = {'+':2, '-':2, '*':2, '/':2, '&':2, '|':2, '!':1, '<':2, '>':2, '==':2, '!=':2,
+                 'm':1, 'gix':1, 'giy':1, 'fix':1, 'fiy':1}
+# number of arguments taken by each command
+COMMAND_ARGS = {'set':2, 'if':2, 'mrk':0, 'ax':1, 'ay':1, 'bst':1, 'pwr':1,
+                'mv':0, 'bir':0, 'att':0, 'ret':0}
+
+# opcodes of compiled commands
+(OP_SET, OP_IF, OP_MRK, OP_AX, OP_AY, OP_BST, OP_PWR, OP_MV, OP_BIR, OP_ATT, OP_RET, OP_JUMP,
+ OP_LOOP, OP_FAIL) = range(14)
+OP_NOP = OP_MRK                 # what optimized-away commands compile to
+OPCODES = {'set':OP_SET, 'if':OP_IF, 'mrk':OP_MRK, 'ax':OP_AX, 'ay':OP_AY, 'bst':OP_BST,
+           'pwr':OP_PWR, 'mv':OP_MV, 'bir':OP_BIR, 'att':OP_ATT, 'ret':OP_RET}
 
 class GermBrain:
     """Manages and runs code for a single organism"""
 
-    def __init__(self, parent_code, mutations):
+    def __init__(self, parent_code, mutations, config=None, rng=None):
         """Class constructor.
 
         Params:
-         - parent_code (list of lists): Object representing the parent's code to be inherited
+         - parent_code (list of lists or Genome): Object representing the parent's code to be
+            inherited. Passing the parent brain's genome avoids re-interning its code.
          - mutations (int): Apply this many mutations to the parent_code
+         - config (TankConfig): Parameters of the germ's tank; defaults to the module constants
+         - rng (Random): Random number generator for mutations; defaults to the random module
         """
 
-        self.code = deepcopy(parent_code)
-        self.memory = [0] * MEMORY_SIZE
+        # the code is shared with every other brain running the same genome until this brain
+        # mutates, at which point it takes a private copy (see make_private)
+        self.genome = parent_code if type(parent_code) is Genome else intern_code(parent_code)
+        self.code = self.genome.code
+        self.marks = self.genome.marks
+        self.mark_ids = None
+        self.site_counts = None
+        # registers holding anything but 0, keyed by register; the rest read as 0
+        self.memory = {}
         self.state = None
-        # collect mark ids present in code
-        # note that mark ids are string in the format f'm{mark_id}'
-        self.mark_ids = {int(i[1][1:]) for i in self.code if i[0] == 'mrk'}
+        self.executed = 0       # commands executed by the last run
+        self.max_executions = config.max_executions if config else MAX_EXECUTIONS
+        self.counts = None      # RunCounts tallied by resolve_value during run_counted
+        self.rng = rng or random
         for i in range(mutations):
             self.mutate()
+        if self.genome is None:
+            self.intern()
 
     def to_dict(self):
-        """Returns a dict representing the code and memory"""
+        """Returns a dict representing the code and memory
+
+        The code is shared with other brains and must not be modified. Memory is a dict of the
+        non-zero registers only.
+        """
 
         return {'code':self.code, 'memory':self.memory}
 
     @staticmethod
-    def from_dict(d):
+    def from_dict(d, config=None):
         """Returns a new GermBrain object based on a dict representation"""
 
-        out = GermBrain(d['code'], 0)
-        out.memory = d['memory']
+        out = GermBrain(d['code'], 0, config)
+        memory = d['memory']
+        if type(memory) is list:
+            # older saves list every register
+            memory = dict(enumerate(memory))
+        # json turns register numbers into strings
+        out.memory = {int(register):value for register, value in memory.items() if value}
         return out
 
 
@@ -47,13 +89,15 @@ class GermBrain:
     def mutate(self):
         """Randomly change code in a single way"""
 
-        flat_code = []
-        for i, elem in enumerate(self.code):
-            flat_code += flatten(elem, [i])
-        if not flat_code:
+        self.make_private()
+        # pick uniformly from the mutable elements of the whole code, as flatten would list them,
+        # but only flatten the command the chosen element is in
+        total = self.site_counts.total()
+        if not total:
             # TODO: Handle case where code becomes empty
             return
-        elem_to_mutate = choice(flat_code)
+        i, site = self.site_counts.find(self.rng.randrange(total))
+        elem_to_mutate = flatten(self.code[i], [i])[site]
         if elem_to_mutate[0] == "cmd":
             self.mutate_command(elem_to_mutate[1:])
         elif elem_to_mutate[0] in ["oper", "val"]:
@@ -65,19 +109,22 @@ class GermBrain:
         """Implement command-level mutation at the specified address"""
 
         command = self.code[address[0]]
-        if choice([True, False]):
+        if self.rng.choice([True, False]):
             # Delete this command
             self.code.pop(address[0])
+            self.site_counts.pop(address[0])
             # if statements require special handling
             if command[0] == 'if':
                 # find and remove the mark whose first argument (the mark id) matches
                 # the if statement's second argument
                 self.mark_ids.remove(int(command[2][1:]))
-                self.code.remove(['mrk', command[2]])
+                index = self.code.index(['mrk', command[2]])
+                self.code.pop(index)
+                self.site_counts.pop(index)
         else:
             # Insert a new command before or after
-            index = address[0] + choice([0, 1])
-            self.code.insert(index, self.rand_command())
+            index = address[0] + self.rng.choice([0, 1])
+            self.insert_command(index, self.rand_command())
 
 
     def mutate_expression(self, address):
@@ -86,79 +133,119 @@ class GermBrain:
         # Change this expression to either a new value or a new operator
         # Except if we're close to max recursion depth, then don't add another layer
         if len(address) < sys.getrecursionlimit() - 10:
-            new_elem = choice([self.rand_value, self.rand_operator])()
+            new_elem = self.rng.choice([self.rand_value, self.rand_operator])()
         else:
             new_elem = self.rand_value()
         elem = self.code
         for i in address[:-1]:
             elem = elem[i]
         elem[address[-1]] = new_elem
+        self.site_counts[address[0]] = count_sites(self.code[address[0]])
 
     def add_rand_mark(self):
         """Insert a new mark (used by if command) randomly in the code and return its unique id"""
 
+        self.make_private()
         if self.mark_ids:
             all_ids = set(range(max(self.mark_ids) + 2))
             new_id = min(all_ids - self.mark_ids)
         else:
             new_id = 0
-        self.code.insert(randrange(len(self.code) + 1), ['mrk', f'm{new_id}'])
+        self.insert_command(self.rng.randrange(len(self.code) + 1), ['mrk', f'm{new_id}'])
         self.mark_ids.add(new_id)
         return f'm{new_id}'
 
+    def insert_command(self, index, command):
+        """Inserts command into the code before index, keeping the mutable site index in step.
+
+        Use this rather than inserting into code directly, which must also be private first.
+        """
+
+        self.make_private()
+        self.code.insert(index, command)
+        self.site_counts.insert(index, count_sites(command))
+
+    def make_private(self):
+        """Gives this brain its own copy of its genome's code so it can be mutated"""
+
+        if self.genome is not None:
+            # number of mutable elements in each command, kept up to date as the code mutates
+            if self.genome.site_counts is None:
+                self.genome.site_counts = [count_sites(cmd) for cmd in self.code]
+            self.site_counts = SiteIndex(self.genome.site_counts)
+            self.code = copy_code(self.code)
+            self.genome = None
+            # mutations shift marks; intern indexes them again once the brain is done mutating
+            self.marks = None
+            # collect mark ids present in code
+            # note that mark ids are string in the format f'm{mark_id}'
+            self.mark_ids = {int(i[1][1:]) for i in self.code if i[0] == 'mrk'}
+
+    def intern(self):
+        """Shares this brain's (mutated) code with any other brain running identical code"""
+
+        self.genome = intern_code(self.code, copy=False)
+        if self.genome.code is self.code:
+            # a new genome, which can keep the site counts rather than recount them
+            self.genome.site_counts = self.site_counts.counts()
+        self.code = self.genome.code
+        self.marks = self.genome.marks
+        self.mark_ids = None
+        self.site_counts = None
+
     def rand_value(self):
         """Returns a random int literal or str special value"""
 
-        cat = randrange(3)
+        cat = self.rng.randrange(3)
         if cat == 0:
             # important integer
-            return randrange(-1, 1)
+            return self.rng.randrange(-1, 1)
         elif cat == 1:
             # any integer
-            return randrange(-500, 500)
+            return self.rng.randrange(-500, 500)
         else:
             # special value
             # note: special values cannot start with 'm', as this format is reserved for mark ids
-            return choice(['energy',
-                           'brightness',
-                           'stamina',
-                           'pain',
-                           'success'])
+            return self.rng.choice(['energy',
+                                    'brightness',
+                                    'stamina',
+                                    'pain',
+                                    'success'])
 
     def rand_operator(self):
         """Returns a list representing a random operator and args"""
 
-        oper = choice([['+', self.rand_value, self.rand_value],
-                       ['-', self.rand_value, self.rand_value],
-                       ['*', self.rand_value, self.rand_value],
-                       ['/', self.rand_value, self.rand_value],
-                       ['&', self.rand_value, self.rand_value],
-                       ['|', self.rand_value, self.rand_value],
-                       ['!', self.rand_value],
-                       ['<', self.rand_value, self.rand_value],
-                       ['>', self.rand_value, self.rand_value],
-                       ['==', self.rand_value, self.rand_value],
-                       ['!=', self.rand_value, self.rand_value],
-                       ['m', self.rand_value],
-                       ['gix', self.rand_value],
-                       ['giy', self.rand_value],
-                       ['fix', self.rand_value],
-                       ['fiy', self.rand_value]])
+        oper = self.rng.choice([['+', self.rand_value, self.rand_value],
+                                ['-', self.rand_value, self.rand_value],
+                                ['*', self.rand_value, self.rand_value],
+                                ['/', self.rand_value, self.rand_value],
+                                ['&', self.rand_value, self.rand_value],
+                                ['|', self.rand_value, self.rand_value],
+                                ['!', self.rand_value],
+                                ['<', self.rand_value, self.rand_value],
+                                ['>', self.rand_value, self.rand_value],
+                                ['==', self.rand_value, self.rand_value],
+                                ['!=', self.rand_value, self.rand_value],
+                                ['m', self.rand_value],
+                                ['gix', self.rand_value],
+                                ['giy', self.rand_value],
+                                ['fix', self.rand_value],
+                                ['fiy', self.rand_value]])
         return [oper[0]] + [i() for i in oper[1:]]
 
     def rand_command(self):
         """Returns a list representing a random command and args"""
 
-        cmd = choice([['set', self.rand_value, self.rand_value],
-                      ['if', self.rand_value, self.add_rand_mark],
-                      ['ax', self.rand_value],
-                      ['ay', self.rand_value],
-                      ['bst', self.rand_value],
-                      ['pwr', self.rand_value],
-                      ['mv'],
-                      ['bir'],
-                      ['att'],
-                      ['ret']])
+        cmd = self.rng.choice([['set', self.rand_value, self.rand_value],
+                               ['if', self.rand_value, self.add_rand_mark],
+                               ['ax', self.rand_value],
+                               ['ay', self.rand_value],
+                               ['bst', self.rand_value],
+                               ['pwr', self.rand_value],
+                               ['mv'],
+                               ['bir'],
+                               ['att'],
+                               ['ret']])
         return [cmd[0]] + [i() for i in cmd[1:]]
 
 
@@ -175,11 +262,14 @@ class GermBrain:
         if type(expr) == int:
             return expr
         elif type(expr) == str:
-            if expr in self.state.keys() and expr != 'view':
-                return int(self.state[expr])
+            if expr in SPECIAL_VALUES:
+                return int(getattr(self.state, expr))
             else:
                 raise KeyError(f'"{expr}" is not a valid special value"')
         elif type(expr) == list:
+            if self.counts is not None:
+                operators = self.counts.operators
+                operators[expr[0]] = operators.get(expr[0], 0) + 1
             if expr[0] == '+':
                 return self.resolve_value(expr[1]) + self.resolve_value(expr[2])
             elif expr[0] == '-':
@@ -209,37 +299,22 @@ class GermBrain:
                 return self.resolve_value(expr[1]) != self.resolve_value(expr[2])
 
             elif expr[0] == 'm':
-                register = self.resolve_value(expr[1]) % len(self.memory)
-                return self.memory[register]
+                register = self.resolve_value(expr[1]) % MEMORY_SIZE
+                return self.memory.get(register, 0)
 
             elif expr[0] == 'gix':
-                try:
-                    index = self.resolve_value(expr[1]) % len(self.state['view']['germs'])
-                    return self.state['view']['germs'][index]['dx']
-                except ZeroDivisionError:
-                    # view is empty
-                    return 0
+                loc = self.state.view.germ(self.resolve_value(expr[1]))
+                # an empty view reads as 0
+                return loc[0] if loc else 0
             elif expr[0] == 'giy':
-                try:
-                    index = self.resolve_value(expr[1]) % len(self.state['view']['germs'])
-                    return self.state['view']['germs'][index]['dy']
-                except ZeroDivisionError:
-                    # view is empty
-                    return 0
+                loc = self.state.view.germ(self.resolve_value(expr[1]))
+                return loc[1] if loc else 0
             elif expr[0] == 'fix':
-                try:
-                    index = self.resolve_value(expr[1]) % len(self.state['view']['food'])
-                    return self.state['view']['food'][index]['dx']
-                except ZeroDivisionError:
-                    # view is empty
-                    return 0
+                loc = self.state.view.food_particle(self.resolve_value(expr[1]))
+                return loc[0] if loc else 0
             elif expr[0] == 'fiy':
-                try:
-                    index = self.resolve_value(expr[1]) % len(self.state['view']['food'])
-                    return self.state['view']['food'][index]['dy']
-                except ZeroDivisionError:
-                    # view is empty
-                    return 0
+                loc = self.state.view.food_particle(self.resolve_value(expr[1]))
+                return loc[1] if loc else 0
 
             else:
                 raise KeyError(f'"{expr}" is not a valid operator')
@@ -247,118 +322,675 @@ class GermBrain:
             raise TypeError(f'"{repr(expr)}" is not a valid expr type '
                             f'({type(expr)})')
 
-    def run(self, state):
+    def run(self, state, counts=None):
         """Execute code and decide what to do next.
 
         Params:
-         - state (dict): The current state of the germ. Keys are:
-             - energy (int): Amount of energy remaining
-             - brightness (int): Amount of sunlight available (inverse of upkeep cost)
-                Scale of 0 to 100 indicating percent of GERM_OPACITY
-             - stamina (int): Amount of stamina remaining
-             - pain (int): Amount of damage taken since last turn
-             - view (list of dict): Data about other objects in the vicinity. Keys are:
-                - id (int): the view identifier for this object
-                - dx (int): the relative x coordinate of the object
-                - dy (int): relative y coordinate
-                - fd (boolean): whether this is a food particle
-             - success (boolean): False if an action was taken last turn resulting
-                in no change of state; otherwise True.
-
-        Returns (dict): Data about what action to take, if any. Possible keys are:
-         - x (int): X-axis direction of action, either -1, 0, or 1
-         - y (int): Y-axis direction of action, either -1, 0, or 1
-         - action (str): Action to take. Either "move", "birth", or "attack".
-            "halt" indicates an execution limit was exceeded.
-         - burst (boolean): If true, spend extra energy to take an extra turn.
-         - power (int): Power committed to attack. Range 0 - 5.
+         - counts (RunCounts): If given, the run is tallied here (see run_counted)
+         - state (SensorState): The current state of the germ
+
+        Returns (SensorState): state, with its request attributes set to the action to take
         """
 
+        if counts is not None:
+            return self.run_counted(state, counts)
         head = 0
         ax = 0
         ay = 0
         burst = False
         power = 0
         executed = 0
+        max_executions = self.max_executions
+        looping = -1            # the last OP_LOOP to branch
         self.state = state
+        if self.genome is None:
+            # mutate was called directly on this brain
+            self.intern()
+        if self.genome.program is None:
+            self.genome.program = CompiledCode(self.code)
+        ops = self.genome.program.ops
+        length = len(ops)
+        marks = self.marks
         try:
-            while executed < MAX_EXECUTIONS:
+            while executed < max_executions:
                 executed += 1
-                if head >= len(self.code):
+                if head >= length:
                     # code end: return and take no action (always successful)
-                    return dict()
-                cmd = self.code[head][0]
+                    return state.request(None)
+                op, arg1, arg2 = ops[head]
 
-                if cmd == 'set':
+                if op == OP_SET:
                     # set the value of a variable
-                    register = self.resolve_value(self.code[head][1]) % len(self.memory)
-                    value = self.resolve_value(self.code[head][2])
-                    self.memory[register] = value
-                elif cmd == 'if':
+                    register = arg1(self) % MEMORY_SIZE
+                    value = arg2(self)
+                    if value:
+                        self.memory[register] = value
+                    else:
+                        # zeroed registers are dropped to keep memory sparse
+                        self.memory.pop(register, None)
+                elif op == OP_IF:
                     # if expr is false, branch head to the corresponding "mark"
-                    expr = self.resolve_value(self.code[head][1])
-                    dest = self.code[head][2]
-                    if not expr:
-                        found = False
-                        for i, elem in enumerate(self.code):
-                            if elem[0] == "mrk" and elem[1] == dest:
-                                head = i
-                                found = True
-                                break
-                        if not found:
-                            raise KeyError(f'Mark "{dest}" not found')
-                elif cmd == 'mrk':
+                    if not arg1(self):
+                        dest = marks.get(arg2)
+                        if dest is None:
+                            raise KeyError(f'Mark "{arg2}" not found')
+                        head = dest
+                elif op == OP_MRK:
                     # destination of an if statement; does nothing by itself
                     pass
 
-                elif cmd == 'ax':
+                elif op == OP_AX:
                     # set the x-direction of the action to be taken
-                    new_x = self.resolve_value(self.code[head][1])
+                    new_x = arg1(self)
                     if new_x < 0:
                         ax = -1
                     elif new_x > 0:
                         ax = 1
                     else:
                         ax = 0
-                elif cmd == 'ay':
+                elif op == OP_AY:
                     # set the y-direction of the action to be taken
-                    new_y = self.resolve_value(self.code[head][1])
+                    new_y = arg1(self)
                     if new_y < 0:
                         ay = -1
                     elif new_y > 0:
                         ay = 1
                     else:
                         ay = 0
+                elif op == OP_BST:
+                    # set burst value for action request
+                    burst = arg1(self) == True
+                elif op == OP_PWR:
+                    # set power value for action request
+                    power = arg1(self) % 6
+
+                elif op == OP_MV:
+                    # return and take the move action
+                    return state.request('move', ax, ay, burst)
+                elif op == OP_BIR:
+                    # return and take the birth action
+                    return state.request('birth', ax, ay, burst)
+                elif op == OP_ATT:
+                    # return and take the attack action
+                    return state.request('attack', ax, ay, burst, power)
+                elif op == OP_RET:
+                    # return and take no action (always successful)
+                    return state.request(None)
+                elif op == OP_JUMP:
+                    # an if whose condition is always false
+                    head = arg2
+                elif op == OP_LOOP:
+                    # an if jumping back over code that can't change memory or leave the loop
+                    # (see find_loops). Having branched here, every later pass evaluates the
+                    # same way, so branching here again means the germ can only halt.
+                    if not arg1(self):
+                        if looping == head:
+                            break
+                        looping = head
+                        head = arg2
+                else:
+                    # malformed command: arg1 raises whatever the interpreter would have
+                    arg1(self)
+                head += 1
+            # execution limit exceeded
+            return state.request('halt')
+
+        except Exception as err:
+            msg = f'Exception raised from germ code (line {head})\n'
+            for i, e in enumerate(self.code):
+                msg += f'{i}: {e}\n'
+            raise RuntimeError(msg) from err
+        finally:
+            self.executed = executed
+
+    def run_counted(self, state, counts):
+        """Does exactly what run does, while tallying each command and operator executed.
+
+        Rather than the compiled code, this interprets the source code directly with
+        resolve_value, so it's considerably slower than run but leaves run's fast path untouched.
+
+        Params:
+         - state (SensorState): The current state of the germ
+         - counts (RunCounts): Tallies to add this run to
+
+        Returns (SensorState): state, with its request attributes set to the action to take
+        """
+
+        head = 0
+        ax = 0
+        ay = 0
+        burst = False
+        power = 0
+        executed = 0
+        max_executions = self.max_executions
+        self.state = state
+        if self.genome is None:
+            # mutate was called directly on this brain
+            self.intern()
+        self.counts = counts
+        code = self.code
+        commands = counts.commands
+        counts.runs += 1
+        try:
+            while executed < max_executions:
+                executed += 1
+                if head >= len(code):
+                    # code end: return and take no action (always successful)
+                    return state.request(None)
+                cmd = code[head][0]
+                commands[cmd] = commands.get(cmd, 0) + 1
+
+                if cmd == 'set':
+                    # set the value of a variable
+                    register = self.resolve_value(code[head][1]) % MEMORY_SIZE
+                    value = self.resolve_value(code[head][2])
+                    if value:
+                        self.memory[register] = value
+                    else:
+                        self.memory.pop(register, None)
+                elif cmd == 'if':
+                    # if expr is false, branch head to the corresponding "mark"
+                    expr = self.resolve_value(code[head][1])
+                    dest = code[head][2]
+                    if not expr:
+                        if dest not in self.marks:
+                            raise KeyError(f'Mark "{dest}" not found')
+                        head = self.marks[dest]
+                elif cmd == 'mrk':
+                    # destination of an if statement; does nothing by itself
+                    pass
+
+                elif cmd == 'ax':
+                    # set the x-direction of the action to be taken
+                    new_x = self.resolve_value(code[head][1])
+                    ax = -1 if new_x < 0 else 1 if new_x > 0 else 0
+                elif cmd == 'ay':
+                    # set the y-direction of the action to be taken
+                    new_y = self.resolve_value(code[head][1])
+                    ay = -1 if new_y < 0 else 1 if new_y > 0 else 0
                 elif cmd == 'bst':
                     # set burst value for action request
-                    burst = self.resolve_value(self.code[head][1]) == True
+                    burst = self.resolve_value(code[head][1]) == True
                 elif cmd == 'pwr':
                     # set power value for action request
-                    power = self.resolve_value(self.code[head][1]) % 6
+                    power = self.resolve_value(code[head][1]) % 6
 
                 elif cmd == 'mv':
                     # return and take the move action
-                    return {'x':ax, 'y':ay, 'action':'move', 'burst':burst}
+                    return state.request('move', ax, ay, burst)
                 elif cmd == 'bir':
                     # return and take the birth action
-                    return {'x':ax, 'y':ay, 'action':'birth', 'burst':burst}
+                    return state.request('birth', ax, ay, burst)
                 elif cmd == 'att':
                     # return and take the attack action
-                    return {'x':ax, 'y':ay, 'action':'attack', 'burst':burst, 'power':power}
+                    return state.request('attack', ax, ay, burst, power)
                 elif cmd == 'ret':
                     # return and take no action (always successful)
-                    return dict()
+                    return state.request(None)
                 else:
                     raise KeyError(f'"{cmd}" is not a valid command')
                 head += 1
             # execution limit exceeded
-            return {'action':'halt'}
+            counts.halts += 1
+            return state.request('halt')
 
         except Exception as err:
+            counts.errors += 1
             msg = f'Exception raised from germ code (line {head})\n'
-            for i, e in enumerate(self.code):
+            for i, e in enumerate(code):
                 msg += f'{i}: {e}\n'
             raise RuntimeError(msg) from err
+        finally:
+            self.executed = executed
+            counts.instructions += executed
+            self.counts = None
+
+class SiteIndex:
+    """The number of mutable elements in each command of a private brain's code.
+
+    Counts are kept in blocks of about SITE_BLOCK commands, each with its total, so finding the
+    command holding a site and inserting or removing a command only go through the block
+    totals and a single block, rather than every command in the code.
+    """
+
+    __slots__ = ['blocks', 'totals']
+
+    def __init__(self, counts):
+        """Class constructor.
+
+        Params:
+         - counts (list of int): The number of mutable elements in each command, in order
+        """
+
+        self.blocks = [counts[i:i + SITE_BLOCK] for i in range(0, len(counts), SITE_BLOCK)]
+        if not self.blocks:
+            self.blocks.append([])
+        self.totals = [sum(block) for block in self.blocks]
+
+    def counts(self):
+        """Returns (list of int): The number of mutable elements in each command"""
+
+        return list(chain.from_iterable(self.blocks))
+
+    def total(self):
+        """Returns (int): The number of mutable elements in the whole code"""
+
+        return sum(self.totals)
+
+    def locate(self, index):
+        """Returns (tuple): The block holding the count of command index, and the count's index
+        within it. An index one past the last command locates the end of the last block.
+        """
+
+        last = len(self.blocks) - 1
+        for b, block in enumerate(self.blocks):
+            if index < len(block) or b == last:
+                return b, index
+            index -= len(block)
+
+    def find(self, site):
+        """Returns (tuple): The index of the command holding a site, counting mutable elements
+        from the start of the code, and the site's index among that command's elements
+        """
+
+        index = 0
+        for block, total in zip(self.blocks, self.totals):
+            if site < total:
+                ends = list(accumulate(block))
+                i = bisect_right(ends, site)
+                return index + i, site - (ends[i - 1] if i else 0)
+            site -= total
+            index += len(block)
+        raise IndexError('site index out of range')
+
+    def insert(self, index, count):
+        """Inserts the count of a new command before command index"""
+
+        b, i = self.locate(index)
+        block = self.blocks[b]
+        block.insert(i, count)
+        self.totals[b] += count
+        if len(block) > SITE_BLOCK * 2:
+            # split the block in two
+            self.blocks[b + 1:b + 1] = [block[SITE_BLOCK:]]
+            del block[SITE_BLOCK:]
+            self.totals[b + 1:b + 1] = [sum(self.blocks[b + 1])]
+            self.totals[b] -= self.totals[b + 1]
+
+    def pop(self, index):
+        """Removes and returns the count of command index"""
+
+        b, i = self.locate(index)
+        count = self.blocks[b].pop(i)
+        self.totals[b] -= count
+        if not self.blocks[b] and len(self.blocks) > 1:
+            del self.blocks[b]
+            del self.totals[b]
+        return count
+
+    def __setitem__(self, index, count):
+        """Sets the count of command index"""
+
+        b, i = self.locate(index)
+        self.totals[b] += count - self.blocks[b][i]
+        self.blocks[b][i] = count
+
+class SensorState:
+    """What a germ senses at the start of its turn, and what it asks to do at the end of it.
+
+    A tank keeps one of these and refills it for each germ's turn, so that running a brain
+    doesn't allocate anything. Sensor attributes, read by GermBrain.run:
+     - energy (int): Amount of energy remaining
+     - brightness (int): Amount of sunlight available (inverse of upkeep cost)
+        Scale of 0 to 100 indicating percent of GERM_OPACITY
+     - stamina (int): Amount of stamina remaining
+     - pain (int): Amount of damage taken since last turn
+     - view (GermView): Lazily evaluated data about other objects in the vicinity.
+        view.germ(i) and view.food_particle(i) return the (dx, dy) relative coordinates
+        of the i-th nearest germ or food particle, or None if there are none in view.
+     - success (boolean): False if an action was taken last turn resulting
+        in no change of state; otherwise True.
+
+    Request attributes, set by GermBrain.run (see request):
+     - action (str): Action to take. Either "move", "birth", or "attack". "halt" indicates an
+        execution limit was exceeded, and None that no action is to be taken.
+     - x (int): X-axis direction of action, either -1, 0, or 1
+     - y (int): Y-axis direction of action, either -1, 0, or 1
+     - burst (boolean): If true, spend extra energy to take an extra turn.
+     - power (int): Power committed to attack. Range 0 - 5.
+    """
+
+    __slots__ = ['energy', 'brightness', 'stamina', 'pain', 'view', 'success',
+                 'action', 'x', 'y', 'burst', 'power']
+
+    def __init__(self, energy=0, brightness=0, stamina=0, pain=0, view=None, success=True):
+        """Class constructor"""
+
+        self.energy = energy
+        self.brightness = brightness
+        self.stamina = stamina
+        self.pain = pain
+        self.view = view
+        self.success = success
+        self.request(None)
+
+    def request(self, action, x=0, y=0, burst=False, power=0):
+        """Sets the request attributes and returns self"""
+
+        self.action = action
+        self.x = x
+        self.y = y
+        self.burst = burst
+        self.power = power
+        return self
+
+class RunCounts:
+    """Tallies of what germ code did over any number of runs, as recorded by run_counted"""
+
+    def __init__(self):
+        """Class constructor"""
+
+        self.runs = 0
+        self.instructions = 0   # commands executed
+        self.halts = 0          # runs stopped by the execution limit
+        self.errors = 0         # runs that raised an exception
+        self.commands = dict.fromkeys(COMMAND_ARGS, 0)      # executions of each command
+        self.operators = dict.fromkeys(OPERATOR_ARGS, 0)    # evaluations of each operator
+
+    def to_dict(self):
+        """Returns a dict representation of the tallies"""
+
+        return {'runs':self.runs,
+                'instructions':self.instructions,
+                'halts':self.halts,
+                'errors':self.errors,
+                'commands':dict(self.commands),
+                'operators':dict(self.operators)}
+
+class Genome:
+    """A piece of germ code, interned so that identical code is stored and compiled only once.
+
+    Brains running the same code all hold the same Genome, which also serves as a stable
+    identity for the code. Its code must never be mutated: brains take a private copy before
+    mutating (GermBrain.make_private) and intern the result once they're done.
+    """
+
+    __slots__ = ['code', 'marks', 'program', 'site_counts', '__weakref__']
+
+    def __init__(self, code):
+        """Class constructor.
+
+        Params:
+         - code (list of lists): The germ code, which the Genome takes ownership of
+        """
+
+        self.code = code
+        self.marks = index_marks(code)
+        # CompiledCode built the first time the code is run
+        self.program = None
+        # number of mutable elements in each command, counted the first time it's mutated
+        self.site_counts = None
+
+# interned genomes keyed by the repr of their code; entries are dropped once no brain uses them
+genomes = WeakValueDictionary()
+
+def intern_code(code, copy=True):
+    """Returns the Genome for code, creating it if no live brain is running identical code.
+
+    Params:
+     - code (list of lists): The germ code to look up
+     - copy (bool): If False, a newly created Genome takes ownership of code instead of copying
+    """
+
+    key = repr(code)
+    genome = genomes.get(key)
+    if genome is None:
+        genome = Genome(copy_code(code) if copy else code)
+        genomes[key] = genome
+    return genome
+
+def copy_code(code):
+    """Returns a deep copy of code, or of any part of it; much faster than copy.deepcopy"""
+
+    if type(code) is list:
+        return [copy_code(elem) for elem in code]
+    return code
+
+def index_marks(code):
+    """Returns a dict mapping each mark id in code to the index of its mrk command.
+
+    Used by run to jump to a mark in constant time. Where a mark id appears more than once,
+    the first occurrence wins, matching a linear scan from the top of the code.
+    """
+
+    marks = {}
+    for i, cmd in enumerate(code):
+        if cmd[0] == 'mrk':
+            marks.setdefault(cmd[1], i)
+    return marks
+
+class CompiledCode:
+    """Germ code translated once into pre-bound closures, shared by every brain running it.
+
+    Each command becomes an (opcode, arg1, arg2) tuple at the same index as in the source code.
+    Expression arguments are compiled to functions taking the running GermBrain and returning
+    exactly what GermBrain.resolve_value would for the original expression.
+
+    Compiling also optimizes: constant expressions are folded, ifs with constant conditions
+    become OP_NOP or OP_JUMP, and ax, ay, bst and pwr values that are always overwritten before
+    use become OP_NOP. Removed commands are replaced rather than deleted, so every command still
+    takes one step and GermBrain.run halts at exactly the same point.
+    """
+
+    __slots__ = ['ops']
+
+    def __init__(self, code):
+        """Class constructor.
+
+        Params:
+         - code (list of lists): The germ code to compile. It must not be mutated afterwards.
+        """
+
+        marks = index_marks(code)
+        self.ops = [compile_command(cmd, marks) for cmd in code]
+        remove_dead_stores(self.ops, code)
+        find_loops(self.ops, marks)
+
+def find_loops(ops, marks):
+    """Turns compiled ifs that can never exit once they branch into OP_LOOP, in place.
+
+    An if qualifies if it jumps back to a mark and everything between the mark and the if only
+    sets ax, ay, bst and pwr, or is another if jumping to a mark in between. None of those can
+    change memory, and expressions only depend on memory and the germ's state, so each pass
+    through the loop evaluates exactly like the last.
+    """
+
+    for i, (op, cond, dest) in enumerate(ops):
+        if op == OP_IF:
+            dest = marks.get(dest, i) if type(dest) is str else i
+        elif op == OP_JUMP:
+            cond = never
+        else:
+            continue
+        if dest >= i:
+            continue
+        for inner, inner_cond, inner_dest in ops[dest + 1:i]:
+            if inner == OP_IF:
+                inner_dest = marks.get(inner_dest, -1) if type(inner_dest) is str else -1
+            if inner in (OP_IF, OP_JUMP, OP_LOOP):
+                if not dest <= inner_dest <= i:
+                    break
+            elif inner not in (OP_MRK, OP_AX, OP_AY, OP_BST, OP_PWR):
+                break
+        else:
+            ops[i] = (OP_LOOP, cond, dest)
+
+def never(brain):
+    """The condition of an if that always branches"""
+
+    return False
+
+# the commands whose values each terminating command reads
+STORES_USED = {OP_MV:{OP_AX, OP_AY, OP_BST},
+               OP_BIR:{OP_AX, OP_AY, OP_BST},
+               OP_ATT:{OP_AX, OP_AY, OP_BST, OP_PWR},
+               OP_RET:set(),
+               OP_FAIL:set()}
+
+def remove_dead_stores(ops, code):
+    """Replaces ax, ay, bst and pwr commands whose value can never be used with OP_NOP, in place.
+
+    A value is dead if, running on from the command without branching, it is overwritten or the
+    code returns without reading it. Commands whose expression could raise are kept.
+    """
+
+    for i, (op, arg1, arg2) in enumerate(ops):
+        if op not in (OP_AX, OP_AY, OP_BST, OP_PWR) or can_raise(code[i][1]):
+            continue
+        for later, later_arg1, later_arg2 in ops[i + 1:]:
+            if later == op or later in STORES_USED:
+                dead = later == op or op not in STORES_USED[later]
+                break
+            elif later not in (OP_SET, OP_MRK, OP_AX, OP_AY, OP_BST, OP_PWR):
+                # branches
+                dead = False
+                break
+        else:
+            # the code ends, returning no action
+            dead = True
+        if dead:
+            ops[i] = (OP_NOP, None, None)
+
+def can_raise(expr):
+    """Returns False if evaluating expr certainly doesn't raise an exception"""
+
+    if type(expr) == int:
+        return False
+    elif type(expr) == str:
+        return expr not in SPECIAL_VALUES
+    elif (type(expr) != list or not expr or type(expr[0]) != str
+          or expr[0] not in OPERATOR_ARGS or len(expr) <= OPERATOR_ARGS[expr[0]]):
+        return True
+    elif expr[0] == '/' and not fold_expr(expr)[1]:
+        # the quotient of big enough ints overflows a float
+        return True
+    return any(can_raise(arg) for arg in expr[1:OPERATOR_ARGS[expr[0]] + 1])
+
+def compile_command(cmd, marks):
+    """Returns an (opcode, arg1, arg2) tuple that GermBrain.run executes in place of cmd
+
+    Params:
+     - cmd (list): The command to compile
+     - marks (dict): Index of each mark in the code, as returned by index_marks
+    """
+
+    name = cmd[0]
+    if type(name) is not str or name not in OPCODES:
+        def fail(brain):
+            raise KeyError(f'"{name}" is not a valid command')
+        return OP_FAIL, fail, None
+    folded = [fold_expr(i) for i in cmd[1:COMMAND_ARGS[name] + 1]]
+    args = [arg for arg, constant in folded]
+    if len(args) < COMMAND_ARGS[name]:
+        # too few arguments: evaluate the ones present, as the interpreter would, then fail
+        def fail(brain):
+            for arg in args:
+                arg(brain)
+            raise IndexError('list index out of range')
+        return OP_FAIL, fail, None
+    if name == 'if':
+        if folded[0][1]:
+            if args[0](None):
+                # never branches
+                return OP_NOP, None, None
+            if type(cmd[2]) is str and cmd[2] in marks:
+                return OP_JUMP, None, marks[cmd[2]]
+        # the mark id is used as-is rather than evaluated
+        return OP_IF, args[0], cmd[2]
+    args += [None] * (2 - len(args))
+    return OPCODES[name], args[0], args[1]
+
+def fold_expr(expr):
+    """Compiles expr into a function of a GermBrain that evaluates it like
+    GermBrain.resolve_value, evaluating any constant parts up front.
+
+    Anything that isn't a well-formed operator, literal or special value is left to
+    resolve_value itself, so malformed code raises the same errors it always has.
+
+    Returns (tuple): The compiled function and whether expr is constant, i.e. doesn't depend on
+        the germ's state, memory or view. A constant expression's function returns its value
+        without evaluating anything and can be called without a brain.
+    """
+
+    if type(expr) == int:
+        return (lambda brain: expr), True
+    elif type(expr) == str and expr in SPECIAL_VALUES:
+        sense = attrgetter(expr)
+        return (lambda brain: int(sense(brain.state))), False
+    elif (type(expr) != list or not expr or type(expr[0]) != str
+          or expr[0] not in OPERATOR_ARGS or len(expr) <= OPERATOR_ARGS[expr[0]]):
+        return (lambda brain: brain.resolve_value(expr)), False
+
+    oper = expr[0]
+    a, constant = fold_expr(expr[1])
+    if OPERATOR_ARGS[oper] == 1:
+        if oper == '!':
+            func = lambda brain: not a(brain)
+        elif oper == 'm':
+            return (lambda brain: brain.memory.get(a(brain) % MEMORY_SIZE, 0)), False
+        else:
+            # view lookups: gix, giy, fix and fiy
+            coord = 0 if oper[2] == 'x' else 1
+            if oper[0] == 'g':
+                def view_lookup(brain):
+                    loc = brain.state.view.germ(a(brain))
+                    return loc[coord] if loc else 0
+            else:
+                def view_lookup(brain):
+                    loc = brain.state.view.food_particle(a(brain))
+                    return loc[coord] if loc else 0
+            return view_lookup, False
+    else:
+        b, b_constant = fold_expr(expr[2])
+        constant = constant and b_constant
+        if oper == '+':
+            func = lambda brain: a(brain) + b(brain)
+        elif oper == '-':
+            func = lambda brain: a(brain) - b(brain)
+        elif oper == '*':
+            func = lambda brain: a(brain) * b(brain)
+        elif oper == '/':
+            def func(brain):
+                try:
+                    return int(a(brain) / b(brain))
+                except ZeroDivisionError:
+                    return DIVIDE_BY_ZERO
+        elif oper == '&':
+            func = lambda brain: a(brain) and b(brain)
+        elif oper == '|':
+            func = lambda brain: a(brain) or b(brain)
+        elif oper == '<':
+            func = lambda brain: a(brain) < b(brain)
+        elif oper == '>':
+            func = lambda brain: a(brain) > b(brain)
+        elif oper == '==':
+            func = lambda brain: a(brain) == b(brain)
+        else:
+            func = lambda brain: a(brain) != b(brain)
+
+    if not constant:
+        return func, False
+    try:
+        value = func(None)
+    except Exception:
+        # e.g. the quotient of huge ints overflowing a float: leave it to raise when run
+        return func, False
+    return (lambda brain: value), True
+
+def count_sites(cmd):
+    """Returns the number of mutable elements flatten finds in the command cmd"""
+
+    return len(flatten(cmd, [0]))
 
 def flatten(code_elem, address):
     """Recursive function that 'flattens' code into a one-dimensional list off mutable elements.
@@ -410,7 +1042,7 @@ def flatten(code_elem, address):
                 out = []
         # now include addresses of any arguments for both commands and operators
         for i, elem in enumerate(code_elem[1:]):
-            out = out + flatten(elem, address + [i + 1])
+            out += flatten(elem, address + [i + 1])
         return out
     else:
         raise TypeError(f'code_elem has an unexpected type: {type(code_elem)}')
@@ -1,11 +1,17 @@
 """Classes and functions built around the tank simulation itself"""
 
 import json
-from math import sqrt
-from random import random, randrange, choice
+from base64 import b64decode, b64encode
+from functools import lru_cache
+from math import sqrt, ceil
+from random import Random, getrandbits
 from operator import itemgetter
+from struct import Struct
+from time import perf_counter_ns
 
-from germ_brain import GermBrain
+import tank_snapshot
+from tank_topology import ADJACENT, BIRTH_ORDERS, direction, get_topology
+from germ_brain import GermBrain, SensorState, MEMORY_SIZE, MAX_EXECUTIONS, intern_code
 
 TANK_WIDTH = 225
 TANK_HEIGHT = 150
@@ -19,10 +25,12 @@ GERM_ABSORB_RATE = 0.5     # What proportion of a prey's energy is gained by a p
 GERM_BASE_ABSORB = 5.0     # Base amount of energy gained by a predator
 GERM_STAMINA = 5.0         # max stamina each germ can have
 GERM_STAMINA_REGEN = 0.5   # amount of stamina germ regenerates each standard turn
-GERM_VIEW_DIST = 10        # view distance of germs; must be 50 or less
+GERM_VIEW_DIST = 10        # view distance of germs
 DEATH_RATE = 0.0001        # chance a germ has of self-destructing each standard turn
 MUTATION_RATE = 0.15       # chance that offspring has of developing mutations
 MULTI_MUT_RATE = 0.5       # chance of developing each additional mutation beyon the first
+FOOD_SPAWN_PROBING = False # regrow food by probing up to 1000 random cells (the original
+                           # behaviour) rather than sampling from the index of empty cells
 
 # energy costs
 # moving one square always costs 1 energy, as a baseline
@@ -43,74 +51,394 @@ STARTING_CODE = [['if', ['>', 'energy', 70], 'm0'],
                  ['ay', ['fiy', 0]],
                  ['mv']]
 
+# independent random number streams each tank has, by what they decide; separate streams keep
+# e.g. a change in how often food moves from changing which germs die
+RNG_STREAMS = ['placement',     # where the first germs and food go, and migration
+               'food',          # food movement and regrowth
+               'death',         # random deaths
+               'mutation']      # mutations of newborn germs' code
+# the internal state of a Random, as returned by getstate, packed for saving
+RNG_STATE = Struct('<625I')
+
+# parameters a TankConfig holds and the module-level constants they default to
+CONFIG_DEFAULTS = {'tank_width':TANK_WIDTH,
+                   'tank_height':TANK_HEIGHT,
+                   'tank_wrap':TANK_WRAP,
+                   'max_food_density':MAX_FOOD_DENSITY,
+                   'food_growth_rate':FOOD_GROWTH_RATE,
+                   'food_energy':FOOD_ENERGY,
+                   'max_germ_energy':MAX_GERM_ENERGY,
+                   'init_germ_energy':INIT_GERM_ENERGY,
+                   'germ_absorb_rate':GERM_ABSORB_RATE,
+                   'germ_base_absorb':GERM_BASE_ABSORB,
+                   'germ_stamina':GERM_STAMINA,
+                   'germ_stamina_regen':GERM_STAMINA_REGEN,
+                   'germ_view_dist':GERM_VIEW_DIST,
+                   'death_rate':DEATH_RATE,
+                   'mutation_rate':MUTATION_RATE,
+                   'multi_mut_rate':MULTI_MUT_RATE,
+                   'food_spawn_probing':FOOD_SPAWN_PROBING,
+                   'upkeep_cost':UPKEEP_COST,
+                   'burst_cost':BURST_COST,
+                   'attack_base_cost':ATTACK_BASE_COST,
+                   'attack_power_cost':ATTACK_POWER_COST,
+                   'birth_cost':BIRTH_COST,
+                   'max_executions':MAX_EXECUTIONS}
+CONFIG_PARAMS = list(CONFIG_DEFAULTS)
+
+class TankConfig:
+    """The parameters a tank runs with, so tanks in one process can differ.
+
+    Each parameter defaults to the module-level constant CONFIG_DEFAULTS maps it to. A config
+    must not be changed once a tank uses it; tanks and brains copy what they need from it into
+    their own attributes.
+    """
+
+    __slots__ = CONFIG_PARAMS + ['view_locs', 'view_offsets']
+
+    def __init__(self, **params):
+        """Class constructor.
+
+        Params:
+         - params: Values for any of the parameters in CONFIG_PARAMS
+        """
+
+        for name, default in CONFIG_DEFAULTS.items():
+            setattr(self, name, params.pop(name) if name in params else default)
+        if params:
+            raise TypeError(f'Unknown tank parameters: {", ".join(params)}')
+        # relative coordinates within view, nearest first, shared by all configs with the same
+        # view distance, and their flat index offsets, valid for germs far enough from every edge
+        self.view_locs = get_view_locs(self.germ_view_dist)
+        self.view_offsets = [dy * self.tank_width + dx for dx, dy in self.view_locs]
+
+    def to_dict(self):
+        """Returns a dict representing the config, as saved with a tank's history"""
+
+        return {name:getattr(self, name) for name in CONFIG_PARAMS}
+
+    @staticmethod
+    def from_dict(d):
+        """Returns a new TankConfig object based on a dict representation"""
+
+        return TankConfig(**d)
+
+@lru_cache
+def get_view_locs(view_dist):
+    """Returns a tuple of the (dx, dy) coordinates visible from a cell, sorted by near to far"""
+
+    # TODO: figure out how to sort by angle of unit circle?
+    view_locs_dist = []
+    for i in range(-view_dist, view_dist + 1):
+        for j in range(-view_dist, view_dist + 1):
+            if not (i == 0 and j == 0):
+                dist = sqrt(i ** 2 + j ** 2)
+                if dist <= view_dist:
+                    view_locs_dist.append(((i, j), dist))
+    view_locs_dist = sorted(view_locs_dist, key=itemgetter(1, 0))
+    return tuple(i[0] for i in view_locs_dist)
+
+class Germ:
+    """A living organism in the tank"""
+
+    __slots__ = ['id', 'brain', 'alive', 'x', 'y', 'energy', 'stamina', 'success', 'burst',
+                 'pain']
+
+    def __init__(self, obj_id, brain, x, y, energy, stamina):
+        """Class constructor.
+
+        Params:
+         - obj_id (int): Id of the germ, unique within its tank for the tank's lifetime
+         - brain (GermBrain): The code that decides the germ's actions
+         - x (int): X coordinate in the tank
+         - y (int): Y coordinate in the tank
+         - energy (float): Starting energy
+         - stamina (float): Starting stamina
+        """
+
+        self.id = obj_id
+        self.brain = brain
+        self.alive = True
+        self.x = x
+        self.y = y
+        self.energy = energy
+        self.stamina = stamina
+        self.success = True
+        self.burst = False
+        self.pain = 0
+
+    def to_dict(self):
+        """Returns a dict representing the germ, as saved in json"""
+
+        return {'id':self.id, 'alive':self.alive, 'x':self.x, 'y':self.y, 'energy':self.energy,
+                'stamina':self.stamina, 'success':self.success, 'burst':self.burst,
+                'pain':self.pain, 'brain':self.brain.to_dict()}
+
+    @staticmethod
+    def from_dict(d, obj_id, config=None):
+        """Returns a new Germ object with the given id based on a dict representation"""
+
+        out = Germ(obj_id, GermBrain.from_dict(d['brain'], config), d['x'], d['y'], d['energy'],
+                   d['stamina'])
+        out.alive = d['alive']
+        out.success = d['success']
+        out.burst = d['burst']
+        out.pain = d['pain']
+        return out
+
+class Food:
+    """A food particle, which is little more than a location in the tank"""
+
+    __slots__ = ['id', 'alive', 'x', 'y']
+
+    # food has no brain; checking obj.brain tells germs and food apart
+    brain = None
+
+    def __init__(self, obj_id, x, y):
+        """Class constructor"""
+
+        self.id = obj_id
+        self.alive = True
+        self.x = x
+        self.y = y
+
+    def to_dict(self):
+        """Returns a dict representing the food particle, as saved in json"""
+
+        return {'id':self.id, 'alive':self.alive, 'x':self.x, 'y':self.y, 'brain':None}
+
+    @staticmethod
+    def from_dict(d, obj_id):
+        """Returns a new Food object with the given id based on a dict representation"""
+
+        out = Food(obj_id, d['x'], d['y'])
+        out.alive = d['alive']
+        return out
+
 class GermTank:
     """Handles the data and execution of the germs in the tank"""
 
-    def __init__(self, json_str=None):
-        """Class constructor that optionally loads from json"""
+    def __init__(self, json_str=None, snapshot=None, config=None, seed=None):
+        """Class constructor that optionally loads from json or a binary snapshot.
+
+        Params:
+         - json_str (str): A tank saved by to_json
+         - snapshot (bytes-like or dict): A tank saved by to_snapshot, e.g. the bytes of a file
+            or an mmap of one, or already read by tank_snapshot.decode
+         - config (TankConfig): Parameters for a new tank, or for a saved one that predates
+            configs; otherwise the config saved with the tank is used. Defaults to TankConfig().
+         - seed (int): Seed for the random numbers of a new tank, or of a saved one that
+            predates seeds; a saved tank otherwise carries on where its random numbers left off.
+            Defaults to a seed drawn from the random module.
+        """
 
-        # self.tank is a list of rows of cells, so it must be accessed with (y, x) coords
-        self.tank = [[None] * TANK_WIDTH for i in range(TANK_HEIGHT)]
-        self.objects = []
+        data = None
+        if snapshot is not None:
+            if not isinstance(snapshot, dict):
+                snapshot = tank_snapshot.decode(snapshot)
+            data = snapshot
+        elif json_str is not None:
+            data = json.loads(json_str)
+        if data and 'config' in data['history']:
+            config = TankConfig.from_dict(data['history']['config'])
+        self.config = config = config or TankConfig()
+        # the dimensions are needed everywhere, so they're kept to hand
+        self.width = width = config.tank_width
+        self.height = height = config.tank_height
+        self.view_dist = view_dist = config.germ_view_dist
+
+        # self.grid is a flat list of cells, row by row; (x, y) is at index y * width + x
+        self.grid = [None] * (width * height)
+        # index of empty cells: free_cells lists them in no particular order and
+        # free_pos[i] is the position of cell i in free_cells, or -1 if it's occupied
+        self.free_cells = list(range(width * height))
+        self.free_pos = list(range(width * height))
+        # lookup tables for flat indices of cells up to view_dist away from any cell:
+        # cols[x + view_dist] is x wrapped into the tank (if it wraps) and
+        # rows[y + view_dist] is the index of the start of row y; either is -1 off the tank
+        self.cols = [x % width if config.tank_wrap or 0 <= x < width else -1
+                     for x in range(-view_dist, width + view_dist)]
+        self.rows = [y * width if 0 <= y < height else -1
+                     for y in range(-view_dist, height + view_dist)]
+        self.view_locs = config.view_locs
+        # grid indices of every cell's neighbours (see tank_topology)
+        self.neighbours = get_topology(width, height, config.tank_wrap).neighbours
+        self.view_offsets = config.view_offsets
+        # upkeep cost and brightness only depend on the row a germ is in
+        self.upkeep_by_row, self.brightness_by_row = get_row_tables(config)
+        # all objects in the tank keyed by id, in the order they take their turns
+        self.objects = {}
+        self.next_id = 0
+        self.id_step = 1        # ids are next_id, next_id + id_step, ... (see tank_bands)
         self.new_germs = []
-
-        if json_str is None:
+        # TankProfiler that update reports to, if profiling is enabled
+        self.profiler = None
+        # refilled for each germ's turn rather than allocated anew
+        self.view = GermView(self, 0, 0)
+        self.sensors = SensorState(view=self.view)
+        self.seed_random(seed)
+
+        if snapshot is not None:
+            self.load_snapshot(snapshot)
+        elif json_str is None:
             self.frames_elapsed = 0
-            # add a starting number of germs and food each equal to TANK_WIDTH
+            # add a starting number of germs and food each equal to the tank width
             # set comprehension ensure rare duplicates are removed
-            self.food_count = TANK_WIDTH
-            locs = {(randrange(TANK_WIDTH), randrange(TANK_HEIGHT)) for i in range(TANK_WIDTH * 2)}
+            # add_germ counts the food as it's added
+            self.food_count = 0
+            randrange = self.rngs['placement'].randrange
+            locs = {(randrange(width), randrange(height)) for i in range(width * 2)}
             c = 0
             for x, y in locs:
-                if c < TANK_WIDTH:
-                    self.objects.append(self.add_germ(x, y, GermBrain(STARTING_CODE, 0)))
+                if c < width:
+                    self.add_object(self.add_germ(x, y, GermBrain(STARTING_CODE, 0, config)))
                 else:
                     # germs with no brain are food particles
-                    self.objects.append(self.add_germ(x, y, None))
+                    self.add_object(self.add_germ(x, y, None))
                 c += 1
         else:
-            data = json.loads(json_str)
-            self.frames_elapsed = data['history']['frames_elapsed']
+            self.set_history(data['history'])
             for d in data['objects']:
-                obj = {i:d[i] for i in d if i != 'brain'}
-                obj['brain'] = GermBrain.from_dict(d['brain']) if d['brain'] else None
-                self.tank[obj['y']][obj['x']] = obj
-                self.objects.append(obj)
-            self.food_count = len([i for i in self.objects if not i['brain']])
-
-        # create view_locs, a list of visible relative coordinates based on GERM_VIEW_DIST
-        # sorted by near to far
-        # TODO: figure out how to sort by angle of unit circle?
-        view_locs_dist = []
-        for i in range(-50, 51):
-            for j in range(-50, 51):
-                if not (i == 0 and j == 0):
-                    dist = sqrt(i ** 2 + j ** 2)
-                    if dist <= GERM_VIEW_DIST:
-                        view_locs_dist.append(((i, j), dist))
-        view_locs_dist = sorted(view_locs_dist, key=itemgetter(1, 0))
-        self.view_locs = [i[0] for i in view_locs_dist]
+                # older saves don't record ids, so number their objects in order
+                obj_id = d['id'] if 'id' in d else len(self.objects)
+                if d['brain']:
+                    obj = Germ.from_dict(d, obj_id, config)
+                else:
+                    obj = Food.from_dict(d, obj_id)
+                self.fill_cell(obj.y * width + obj.x, obj)
+                self.add_object(obj)
+                self.next_id = max(self.next_id, obj_id + 1)
+            self.food_count = len([i for i in self.objects.values() if not i.brain])
 
     def to_json(self):
         """Dumps the object list to json"""
 
-        out = []
-        for obj in self.objects:
-            d = {i:obj[i] for i in obj if i != 'brain'}
-            d['brain'] = obj['brain'].to_dict() if obj['brain'] else None
-            out.append(d)
-        return json.dumps({'objects':out, 'history':{'frames_elapsed':self.frames_elapsed}})
+        out = [obj.to_dict() for obj in self.objects.values()]
+        return json.dumps({'objects':out, 'history':self.get_history()})
+
+    def to_snapshot(self):
+        """Dumps the tank to a compact binary snapshot (see tank_snapshot)"""
+
+        return tank_snapshot.encode(tank_snapshot.capture(self), MEMORY_SIZE)
+
+    def load_snapshot(self, data):
+        """Populates an empty tank from the result of tank_snapshot.decode"""
+
+        self.set_history(data['history'])
+        # decoded germs with the same genome share one code list
+        genomes = {}
+        for record in data['objects']:
+            if len(record) == 4:
+                obj = Food(record[0], record[2], record[3])
+            else:
+                obj = self.germ_from_record(record, genomes)
+            obj.alive = record[1]
+            self.fill_cell(obj.y * self.width + obj.x, obj)
+            self.add_object(obj)
+        self.food_count = len([i for i in self.objects.values() if not i.brain])
+
+    def germ_from_record(self, record, genomes):
+        """Returns a new Germ from a decoded snapshot record (see tank_snapshot.decode).
+
+        Params:
+         - record (tuple): The germ's record
+         - genomes (dict): Genomes already interned for decoded code lists, keyed by the id of
+            the list; updated with the germ's genome
+        """
+
+        obj_id, alive, x, y, energy, stamina, success, burst, pain, code, memory = record
+        if id(code) not in genomes:
+            genomes[id(code)] = intern_code(code, copy=False)
+        brain = GermBrain(genomes[id(code)], 0, self.config)
+        brain.memory = memory
+        germ = Germ(obj_id, brain, x, y, energy, stamina)
+        germ.success = success
+        germ.burst = burst
+        germ.pain = pain
+        return germ
+
+    def emigrate(self, count):
+        """Removes up to count randomly chosen living germs from the tank, to be added to
+        another tank with immigrate. Must be called between frames.
+
+        Returns (bytes): The germs as a snapshot (see tank_snapshot) with no food
+        """
+
+        germs = [obj for obj in self.objects.values() if obj.brain and obj.alive]
+        migrants = self.rngs['placement'].sample(germs, min(count, len(germs)))
+        objects = [tank_snapshot.capture_object(germ) for germ in migrants]
+        for germ in migrants:
+            self.kill_germ(germ)
+        history = {'frames_elapsed':self.frames_elapsed, 'next_id':self.next_id}
+        return tank_snapshot.encode({'history':history, 'objects':objects}, MEMORY_SIZE)
+
+    def immigrate(self, data):
+        """Adds germs returned by another tank's emigrate, each with a new id at a random empty
+        cell. Germs that don't fit in the tank are dropped. Must be called between frames.
+
+        Returns (int): The number of germs added
+        """
+
+        genomes = {}
+        added = 0
+        rng = self.rngs['placement']
+        for record in tank_snapshot.decode(data)['objects']:
+            if not self.free_cells:
+                break
+            germ = self.germ_from_record(record, genomes)
+            index = self.sample_free_cells(rng, 1)[0]
+            germ.id = self.next_id
+            germ.x = index % self.width
+            germ.y = index // self.width
+            self.next_id += self.id_step
+            self.fill_cell(index, germ)
+            self.add_object(germ)
+            added += 1
+        return added
+
+    def get_history(self):
+        """Returns a dict of the tank's history, as saved alongside its objects"""
+
+        return {'frames_elapsed':self.frames_elapsed, 'next_id':self.next_id,
+                'config':self.config.to_dict(), 'seed':self.seed,
+                'rng':{name:pack_rng_state(rng) for name, rng in self.rngs.items()}}
+
+    def set_history(self, history):
+        """Restores the tank's history from a dict returned by get_history.
+
+        The config isn't restored here, as the tank is built around it; see __init__.
+        """
+
+        self.frames_elapsed = history['frames_elapsed']
+        # older saves don't record next_id; loading objects raises it past every id in use
+        self.next_id = history.get('next_id', 0)
+        # nor their random number streams, which then keep the seed given to __init__
+        if 'rng' in history:
+            self.seed = history['seed']
+            for name, state in history['rng'].items():
+                self.rngs[name].setstate(unpack_rng_state(state))
+
+    def seed_random(self, seed=None):
+        """Restarts each of the tank's random number streams (see RNG_STREAMS) from a seed.
+
+        Params:
+         - seed (int): Seed that each stream's seed is derived from; defaults to a seed drawn
+            from the random module
+        """
+
+        self.seed = getrandbits(64) if seed is None else seed
+        self.rngs = {name:Random(f'{self.seed}:{name}') for name in RNG_STREAMS}
 
     def get_stats(self):
         """Returns a dict with statistical data"""
 
         energy = 0.0
         germ_count = 0
-        for i in self.objects:
-            energy += i['energy'] if 'energy' in i else 20
-            if i['brain']:
+        for i in self.objects.values():
+            energy += i.energy if i.brain else 20
+            if i.brain:
                 germ_count += 1
-        return {'energy_density': energy / TANK_WIDTH / TANK_HEIGHT,
+        return {'energy_density': energy / self.width / self.height,
                 'frames_elapsed': self.frames_elapsed,
                 'germ_count': germ_count}
 
@@ -119,170 +447,215 @@ class GermTank:
 
         def get_pixel(obj):
             if obj:
-                if obj['brain']:
+                if obj.brain:
                     return "white"
                 else:
                     return "green"
             else:
                 return "black"
-        return [[get_pixel(p) for p in self.tank[i]] for i in range(TANK_HEIGHT)]
+        width = self.width
+        return [[get_pixel(p) for p in self.grid[i * width:(i + 1) * width]]
+                for i in range(self.height)]
+
+    def get_cell(self, x, y):
+        """Returns the object at (x, y), or None if the cell is empty"""
+
+        return self.grid[y * self.width + x]
 
     def kill_germ(self, germ):
         """Destroys the given germ"""
 
-        if not germ['brain']:
+        if not germ.brain:
             self.food_count -= 1
-        self.objects.remove(germ)
-        self.tank[germ['y']][germ['x']] = None
+        del self.objects[germ.id]
+        self.empty_cell(germ.y * self.width + germ.x)
+
+    def add_object(self, obj):
+        """Registers an object created by add_germ so that it takes turns"""
+
+        self.objects[obj.id] = obj
 
     def add_germ(self, x, y, germ_brain):
-        """Creates a new germ at the given location"""
+        """Creates a new germ at the given location.
+
+        The returned object has a new id but isn't registered until passed to add_object.
+        """
 
-        if self.tank[y][x]:
+        if self.grid[y * self.width + x]:
             raise RuntimeError(f'Location ({x}, {y}) already occupied')
         if germ_brain:
-            germ = {
-                'brain':germ_brain,
-                'alive':True,
-                'x':x,
-                'y':y,
-                'energy':INIT_GERM_ENERGY,
-                'stamina':GERM_STAMINA,
-                'success':True,
-                'burst':False,
-                'pain':0}
+            germ = Germ(self.next_id, germ_brain, x, y, self.config.init_germ_energy,
+                        self.config.germ_stamina)
         else:
             # germs with no brain are food particles
             self.food_count += 1
-            germ = {
-                'brain':None,
-                'alive':True,
-                'x':x,
-                'y':y}
-        self.tank[y][x] = germ
+            germ = Food(self.next_id, x, y)
+        self.next_id += self.id_step
+        self.fill_cell(y * self.width + x, germ)
         return germ
 
-    def get_view(self, x, y):
-        """Returns a view object for a germ at the given location."""
-
-        def get_obj(dx, dy):
-            tgt_x, tgt_y = self.get_relative_loc(x, y, dx, dy)
-            if tgt_x != -1:
-                tdx = tgt_x - x
-                tdy = tgt_y - y
-                cell = self.tank[tgt_y][tgt_x]
-                if cell and cell['alive']:
-                    return {'dx':tdx, 'dy':tdy, 'is_food':cell['brain'] is None}
-            return None
-        objs = [get_obj(dx, dy) for dx, dy in self.view_locs]
-        germs = [i for i in objs if i and not i['is_food']]
-        food = [i for i in objs if i and i['is_food']]
-        return {'germs':germs, 'food':food}
+    def fill_cell(self, index, obj):
+        """Places obj in the empty cell at the given grid index"""
+
+        self.grid[index] = obj
+        # swap the last free cell into this cell's place in the free cell index
+        pos = self.free_pos[index]
+        last = self.free_cells.pop()
+        if last != index:
+            self.free_cells[pos] = last
+            self.free_pos[last] = pos
+        self.free_pos[index] = -1
+
+    def empty_cell(self, index):
+        """Removes whatever occupies the cell at the given grid index"""
+
+        self.grid[index] = None
+        self.free_pos[index] = len(self.free_cells)
+        self.free_cells.append(index)
+
+    def sample_free_cells(self, rng, count):
+        """Returns (list of int): The grid indices of count different empty cells, chosen at
+        random.
+
+        The choice only depends on rng and which cells are empty, not on the order of
+        free_cells, which isn't saved; so a loaded tank makes the same choices as the original.
+
+        Params:
+         - rng (Random): The random number stream to choose with
+         - count (int): Number of cells, at most len(free_cells)
+        """
+
+        grid = self.grid
+        if len(self.free_cells) * 2 < len(grid):
+            # mostly full, so picking cells at random would rarely find an empty one
+            return rng.sample(sorted(self.free_cells), count)
+        cells = []
+        chosen = set()
+        while len(cells) < count:
+            index = rng.randrange(len(grid))
+            if not grid[index] and index not in chosen:
+                cells.append(index)
+                chosen.add(index)
+        return cells
 
     def get_birth_loc(self, x, y, dx, dy):
-        """Gets a suitable birth location relative to (x, y) as close as possible to request"""
-
-        # each loc is a 3-tuple of x, y, and d, the distance from original request
-        locs = []
-        for i in [-1, 0, 1]:
-            for j in [-1, 0, 1]:
-                if not (i == 0 and j == 0):
-                    locs.append((i, j, abs(dx - i) + abs(dy - j)))
-        locs = sorted(locs, key=itemgetter(2))
-        for ndx, ndy, d in locs:
-            new_x, new_y = self.get_relative_loc(x, y, ndx, ndy)
-            if new_x != -1 and not self.tank[new_y][new_x]:
-                return new_x, new_y
-        return -1, -1
+        """Gets a suitable birth location relative to (x, y) as close as possible to request.
 
-    @staticmethod
-    def get_relative_loc(x, y, dx, dy):
-        """Gets a new location relative to (x, y) accounting for tank dimensions"""
-
-        new_x = x + dx
-        if TANK_WRAP:
-            if new_x >= TANK_WIDTH:
-                new_x -= TANK_WIDTH
-            elif new_x < 0:
-                new_x += TANK_WIDTH
-        elif new_x >= TANK_WIDTH or new_x < 0:
-            return -1, -1
-        new_y = y + dy
-        if new_y >= TANK_HEIGHT or new_y < 0:
-            return -1, -1
-        return new_x, new_y
+        dx and dy must each be -1, 0 or 1.
+        """
+
+        grid = self.grid
+        neighbours = self.neighbours[y * self.width + x]
+        for n in BIRTH_ORDERS[direction(dx, dy)]:
+            index = neighbours[n]
+            if index != -1 and not grid[index]:
+                return index % self.width, index // self.width
+        return -1, -1
 
     def dine(self, germ):
         """Allow the supplied germ to consume one adjacent food particle"""
 
         # germs can only eat if they can absorb all the energy
-        if germ['energy'] + FOOD_ENERGY < MAX_GERM_ENERGY:
-            locs = []
-            for i in [-1, 0, 1]:
-                for j in [-1, 0, 1]:
-                    if not (i == 0 and j == 0):
-                        locs.append((i, j))
-            for dx, dy in locs:
-                tgt_x, tgt_y = self.get_relative_loc(germ['x'], germ['y'], dx, dy)
-                target = self.tank[tgt_y][tgt_x]
-                if target and not target['brain'] and target['alive']:
-                    germ['energy'] += FOOD_ENERGY
-                    target['alive'] = False
+        food_energy = self.config.food_energy
+        if germ.energy + food_energy < self.config.max_germ_energy:
+            grid = self.grid
+            for index in self.neighbours[germ.y * self.width + germ.x]:
+                # the germ's own cell is in its neighbourhood, but it isn't food
+                if index == -1:
+                    continue
+                target = grid[index]
+                if target and not target.brain and target.alive:
+                    germ.energy += food_energy
+                    target.alive = False
+
+    def walk_food(self, food):
+        """Moves each food particle one step in a random direction if the cell there is empty.
+
+        Directions for all particles are drawn in a single batch. Particles then move in the
+        order given, so when two particles head for the same cell the first one gets it.
+        """
+
+        grid = self.grid
+        neighbours = self.neighbours
+        width = self.width
+        for particle, n in zip(food, self.rngs['food'].choices(ADJACENT, k=len(food))):
+            if not particle.alive:
+                # eaten earlier this frame
+                continue
+            cell = particle.y * width + particle.x
+            index = neighbours[cell][n]
+            if index != -1 and not grid[index]:
+                self.empty_cell(cell)
+                self.fill_cell(index, particle)
+                particle.x = index % width
+                particle.y = index // width
 
     def process_request(self, request, germ, x, y):
-        """Process a request returned by a germ"""
+        """Process a request returned by a germ
 
+        Params:
+         - request (SensorState): As returned by GermBrain.run
+         - germ (Germ): The germ making the request
+         - x (int): X coordinate of the germ
+         - y (int): Y coordinate of the germ
+        """
+
+        config = self.config
         # TODO: Don't spend burst if next turn is a standard
-        if 'burst' in request and request['burst']:
-            germ['energy'] -= BURST_COST
-            germ['burst'] = True
+        if request.burst:
+            germ.energy -= config.burst_cost
+            germ.burst = True
         else:
-            germ['burst'] = False
-
-        if 'action' not in request:
-            germ['success'] = True
-        elif request['action'] == 'halt':
-            germ['success'] = False
-            germ['energy'] -= 1
-
-        elif request['action'] == 'move':
-            new_x, new_y = self.get_relative_loc(x, y, request['x'], request['y'])
-            if new_x == -1 or self.tank[new_y][new_x]:
-                germ['success'] = False
+            germ.burst = False
+
+        if request.action is None:
+            germ.success = True
+        elif request.action == 'halt':
+            germ.success = False
+            germ.energy -= 1
+
+        elif request.action == 'move':
+            index = self.neighbours[y * self.width + x][direction(request.x, request.y)]
+            if index == -1 or self.grid[index]:
+                germ.success = False
             else:
-                germ['success'] = True
-                germ['energy'] -= sqrt(request['x'] ** 2 + request['y'] ** 2)
-                germ['x'] = new_x
-                germ['y'] = new_y
-                self.tank[new_y][new_x] = germ
-                self.tank[y][x] = None
-
-        elif request['action'] == 'birth':
-            new_x, new_y = self.get_birth_loc(x, y, request['x'], request['y'])
-            if new_x == -1 or germ['energy'] < INIT_GERM_ENERGY + BIRTH_COST + 1:
-                germ['success'] = False
+                germ.success = True
+                germ.energy -= sqrt(request.x ** 2 + request.y ** 2)
+                germ.x = index % self.width
+                germ.y = index // self.width
+                self.empty_cell(y * self.width + x)
+                self.fill_cell(index, germ)
+
+        elif request.action == 'birth':
+            new_x, new_y = self.get_birth_loc(x, y, request.x, request.y)
+            if new_x == -1 or germ.energy < config.init_germ_energy + config.birth_cost + 1:
+                germ.success = False
             else:
-                germ['success'] = True
-                germ['energy'] -= INIT_GERM_ENERGY + BIRTH_COST
-                self.new_germs.append(
-                    self.add_germ(new_x, new_y, GermBrain(germ['brain'].code, random_mutations())))
-
-        elif request['action'] == 'attack':
-            tgt_x, tgt_y = self.get_relative_loc(x, y, request['x'], request['y'])
-            cost = ATTACK_BASE_COST + ATTACK_POWER_COST * float(request['power'])
-            target = self.tank[tgt_y][tgt_x]
-            if not target or not target['alive'] or not request['power'] or cost > germ['energy']:
-                germ['success'] = False
+                germ.success = True
+                germ.energy -= config.init_germ_energy + config.birth_cost
+                rng = self.rngs['mutation']
+                brain = GermBrain(germ.brain.genome, random_mutations(config, rng), config, rng)
+                self.new_germs.append(self.add_germ(new_x, new_y, brain))
+
+        elif request.action == 'attack':
+            index = self.neighbours[y * self.width + x][direction(request.x, request.y)]
+            cost = config.attack_base_cost + config.attack_power_cost * float(request.power)
+            target = self.grid[index] if index != -1 else None
+            # food can only be eaten, not attacked
+            if (not target or not target.brain or not target.alive or not request.power
+                    or cost > germ.energy):
+                germ.success = False
             else:
-                germ['success'] = True
-                germ['energy'] -= cost
-                target['stamina'] -= request['power']
-                target['pain'] += request['power']
-                if target['stamina'] <= 0:
-                    germ['energy'] += max(
-                        MAX_GERM_ENERGY,
-                        (target['energy'] - GERM_BASE_ABSORB) * GERM_ABSORB_RATE + GERM_BASE_ABSORB)
-                    target['alive'] = False
+                germ.success = True
+                germ.energy -= cost
+                target.stamina -= request.power
+                target.pain += request.power
+                if target.stamina <= 0:
+                    germ.energy += max(
+                        config.max_germ_energy,
+                        (target.energy - config.germ_base_absorb) * config.germ_absorb_rate
+                        + config.germ_base_absorb)
+                    target.alive = False
 
     def update(self, burst_turn):
         """Gives all germs a turn.
@@ -292,81 +665,230 @@ class GermTank:
         """
 
         self.frames_elapsed += 1
-        for germ in self.objects:
-            if germ['alive']:
+        config = self.config
+        germ_stamina = config.germ_stamina
+        germ_stamina_regen = config.germ_stamina_regen
+        death_rate = config.death_rate
+        death_random = self.rngs['death'].random
+        upkeep_by_row = self.upkeep_by_row
+        brightness_by_row = self.brightness_by_row
+        sensors = self.sensors
+        view = self.view
+        # profiler calls are all behind a check of this, so they cost nothing when it's None
+        profiler = self.profiler
+        run_counts = None
+        if profiler:
+            start = perf_counter_ns()
+            run_counts = profiler.run_counts
+        food = []
+        for germ in self.objects.values():
+            if germ.alive:
                 # germ or food?
-                if germ['brain']:
+                if germ.brain:
                     # on standard turns, do upkeep tasks
                     if not burst_turn:
-                        germ['energy'] -= UPKEEP_COST * (0.1 + 0.9 * (float(germ['y']) / TANK_HEIGHT))
-                        if germ['stamina'] < GERM_STAMINA:
-                            germ['stamina'] += GERM_STAMINA_REGEN
-                            germ['stamina'] = min(germ['stamina'], GERM_STAMINA)
-                        if germ['energy'] <= 0 or random() < DEATH_RATE:
-                            germ['alive'] = False
+                        germ.energy -= upkeep_by_row[germ.y]
+                        if germ.stamina < germ_stamina:
+                            germ.stamina += germ_stamina_regen
+                            germ.stamina = min(germ.stamina, germ_stamina)
+                        if germ.energy <= 0 or death_random() < death_rate:
+                            germ.alive = False
+                            if profiler:
+                                start = profiler.lap('upkeep', start)
                             continue
+                        if profiler:
+                            start = profiler.lap('upkeep', start)
 
                     # if this is a standard turn or the germ paid for a burst, take action
-                    if not burst_turn or germ['burst']:
+                    if not burst_turn or germ.burst:
                         self.dine(germ)
-                        brightness = (1.0 -  0.9 * (float(germ['y']) / TANK_HEIGHT))
-                        request = germ['brain'].run(
-                            {'energy':germ['energy'],
-                             'brightness':brightness,
-                             'stamina':germ['stamina'],
-                             'pain':germ['pain'],
-                             'view':self.get_view(germ['x'], germ['y']),
-                             'success':germ['success']})
-                        self.process_request(request, germ, germ['x'], germ['y'])
+                        if profiler:
+                            start = profiler.lap('dine', start)
+                        view.reset(germ.x, germ.y)
+                        sensors.energy = germ.energy
+                        sensors.brightness = brightness_by_row[germ.y]
+                        sensors.stamina = germ.stamina
+                        sensors.pain = germ.pain
+                        sensors.success = germ.success
+                        if profiler:
+                            start = profiler.lap('view', start)
+                        request = germ.brain.run(sensors, run_counts)
+                        if profiler:
+                            start = profiler.lap('brain', start)
+                            profiler.count_turn(germ.brain, view, request)
+                        self.process_request(request, germ, germ.x, germ.y)
 
                         # pain only tracks since last turn; also recheck energy
-                        germ['pain'] = 0
+                        germ.pain = 0
+                        if profiler:
+                            start = profiler.lap('request', start)
 
                 # food particle
                 elif not burst_turn:
-                    # it moves in a random direction if possible
-                    locs = []
-                    for i in [-1, 0, 1]:
-                        for j in [-1, 0, 1]:
-                            if not (i == 0 and j == 0):
-                                locs.append((i, j))
-                    dx, dy = choice(locs)
-                    new_x, new_y = self.get_relative_loc(germ['x'], germ['y'], dx, dy)
-                    if new_x != -1 and not self.tank[new_y][new_x]:
-                        old_x = germ['x']
-                        old_y = germ['y']
-                        germ['x'] = new_x
-                        germ['y'] = new_y
-                        self.tank[new_y][new_x] = germ
-                        self.tank[old_y][old_x] = None
+                    food.append(germ)
 
+        # food particles all move at once, after germs have taken their turns
+        if food:
+            self.walk_food(food)
+        if profiler:
+            start = profiler.lap('food_walk', start)
 
         # kill germs marked for death and register new ids
-        to_kill = [i for i in self.objects if not i['alive']]
+        to_kill = [i for i in self.objects.values() if not i.alive]
         for i in to_kill:
             self.kill_germ(i)
-        self.objects.extend(self.new_germs)
+        for i in self.new_germs:
+            self.add_object(i)
+        if profiler:
+            profiler.counts['deaths'] += len(to_kill)
+            profiler.counts['births'] += len(self.new_germs)
+            start = profiler.lap('sweep', start)
+            food_count = self.food_count
         self.new_germs = []
 
         # regenerate food
-        max_food =  TANK_WIDTH * TANK_HEIGHT * MAX_FOOD_DENSITY
+        max_food =  self.width * self.height * config.max_food_density
         if self.food_count < max_food:
-            to_add = min(FOOD_GROWTH_RATE * max_food, max_food - self.food_count)
-            c = 0
-            # check up to 1000 random locations for openings
-            for i in range(1000):
-                x = randrange(TANK_WIDTH)
-                y = randrange(TANK_HEIGHT)
-                if not self.tank[y][x]:
-                    self.objects.append(self.add_germ(x, y, None))
-                    c += 1
-                    if c >= to_add:
-                        break
-
-def random_mutations():
-    if random() < MUTATION_RATE:
+            to_add = min(config.food_growth_rate * max_food, max_food - self.food_count)
+            rng = self.rngs['food']
+            if config.food_spawn_probing:
+                c = 0
+                # check up to 1000 random locations for openings
+                for i in range(1000):
+                    x = rng.randrange(self.width)
+                    y = rng.randrange(self.height)
+                    if not self.grid[y * self.width + x]:
+                        self.add_object(self.add_germ(x, y, None))
+                        c += 1
+                        if c >= to_add:
+                            break
+            else:
+                # pick the cells up front, as adding food reorders free_cells
+                count = min(ceil(to_add), len(self.free_cells))
+                for index in self.sample_free_cells(rng, count):
+                    self.add_object(self.add_germ(index % self.width, index // self.width, None))
+        if profiler:
+            profiler.counts['food_added'] += self.food_count - food_count
+            profiler.lap('regrowth', start)
+            profiler.frames += 1
+
+class GermView:
+    """The objects visible to a germ, found nearest-first only as far as the germ asks for.
+
+    Most germ code never looks further than the nearest food particle, if it looks at all, so
+    rather than scanning every cell within view distance up front, cells are scanned in
+    view_locs order on demand and the germs and food found so far are kept for later lookups.
+    Objects are recorded as (dx, dy) tuples, nearest first, in view_locs order.
+    """
+
+    def __init__(self, tank, x, y):
+        """Class constructor.
+
+        Params:
+         - tank (GermTank): The tank the viewing germ lives in
+         - x (int): X coordinate of the viewing germ
+         - y (int): Y coordinate of the viewing germ
+        """
+
+        self.tank = tank
+        self.x = x
+        self.y = y
+        self.germs = []
+        self.food = []
+        self.scanned = 0    # number of view_locs examined so far
+
+    def reset(self, x, y):
+        """Moves the view to another germ's location, forgetting everything seen so far"""
+
+        self.x = x
+        self.y = y
+        self.germs.clear()
+        self.food.clear()
+        self.scanned = 0
+
+    def germ(self, index):
+        """Returns (dx, dy) of the germ at index (modulo the number visible) or None if none"""
+
+        if index >= len(self.germs) or index < 0:
+            self.scan(self.germs, index)
+        if not self.germs:
+            return None
+        return self.germs[index % len(self.germs)]
+
+    def food_particle(self, index):
+        """Returns (dx, dy) of the food at index (modulo the number visible) or None if none"""
+
+        if index >= len(self.food) or index < 0:
+            self.scan(self.food, index)
+        if not self.food:
+            return None
+        return self.food[index % len(self.food)]
+
+    def scan(self, found, index):
+        """Scans further until found has an entry at index, or to the end if index is negative"""
+
+        x = self.x
+        y = self.y
+        tank = self.tank
+        grid = tank.grid
+        view_locs = tank.view_locs
+        view_dist = tank.view_dist
+        i = self.scanned
+        if (view_dist <= x < tank.width - view_dist
+                and view_dist <= y < tank.height - view_dist):
+            # the whole view is on the tank and unwrapped, so flat offsets can be used directly
+            start = y * tank.width + x
+            view_offsets = tank.view_offsets
+            while i < len(view_locs) and (index < 0 or index >= len(found)):
+                cell = grid[start + view_offsets[i]]
+                if cell and cell.alive:
+                    if cell.brain is None:
+                        self.food.append(view_locs[i])
+                    else:
+                        self.germs.append(view_locs[i])
+                i += 1
+        else:
+            cols = tank.cols
+            rows = tank.rows
+            while i < len(view_locs) and (index < 0 or index >= len(found)):
+                dx, dy = view_locs[i]
+                i += 1
+                col = cols[x + dx + view_dist]
+                row = rows[y + dy + view_dist]
+                if col != -1 and row != -1:
+                    cell = grid[row + col]
+                    if cell and cell.alive:
+                        if cell.brain is None:
+                            self.food.append((col - x, dy))
+                        else:
+                            self.germs.append((col - x, dy))
+        self.scanned = i
+
+def get_row_tables(config):
+    """Returns (tuple of list): The upkeep cost and brightness of each row of a tank"""
+
+    height = config.tank_height
+    return ([config.upkeep_cost * (0.1 + 0.9 * (float(y) / height)) for y in range(height)],
+            [(1.0 -  0.9 * (float(y) / height)) for y in range(height)])
+
+def pack_rng_state(rng):
+    """Returns (list): The state of a Random as json-friendly [version, base64 state, gauss]"""
+
+    version, internal, gauss_next = rng.getstate()
+    return [version, b64encode(RNG_STATE.pack(*internal)).decode(), gauss_next]
+
+def unpack_rng_state(state):
+    """Returns (tuple): A Random state, as for setstate, from the result of pack_rng_state"""
+
+    version, internal, gauss_next = state
+    return version, RNG_STATE.unpack(b64decode(internal)), gauss_next
+
+def random_mutations(config, rng):
+    """Returns a random number of mutations for a newborn germ's brain"""
+
+    if rng.random() < config.mutation_rate:
         count = 1
-        while random() < MULTI_MUT_RATE:
+        while rng.random() < config.multi_mut_rate:
             count += 1
         return count
     else:
@@ -0,0 +1,468 @@
+"""Runs one large tank across several processes by splitting it into horizontal bands"""
+
+import os
+import random
+import signal
+from bisect import bisect_right
+from multiprocessing import Pipe, Process
+from multiprocessing.shared_memory import SharedMemory
+from time import time_ns
+
+import tank_snapshot
+from germ_brain import MEMORY_SIZE
+from germ_tank import GermTank, TankConfig, Germ, Food, get_row_tables
+from tank_checkpoint import load_checkpoint, write_tmp
+from tank_topology import BIRTH_ORDERS, CENTRE
+
+BANDS_AUTOSAVE = 'autosave.tank'    # snapshot the banded runner resumes from and saves to
+BAND_CHECKPOINT_INTERVAL = 5000     # frames between saves of the whole tank
+BAND_STATS_INTERVAL = 1000          # frames between printing stats
+
+# kinds of cell in the shared edge rows
+EMPTY = 0
+FOOD = 1
+GERM = 2
+
+class BandedTank:
+    """A tank split into horizontal bands of rows, each updated by its own worker process.
+
+    A band's worker owns every object in its rows and runs an ordinary GermTank holding them,
+    with halo rows above and below as deep as the view distance. Each frame, every band
+    publishes the rows its neighbours see as halo through shared memory, and fills its own
+    halo with ghosts of the objects there: stand-ins that germs can see, eat and attack, but
+    that don't take turns. After each frame, objects that moved, were born or spawned into a
+    halo are handed over to the band owning those rows. Damage done to ghosts is sent back to
+    their owners too. Both are reconciled by the receiving band at the start of the next frame,
+    in a fixed order, so a run only depends on its seeds.
+
+    Compared with a single GermTank, a germ sees its neighbours' halo as it was at the end of
+    the previous frame, and whether a ghost died is decided by its owner.
+    """
+
+    def __init__(self, tank, bands, seed=None):
+        """Class constructor.
+
+        Params:
+         - tank (GermTank): The tank to split into bands; it isn't changed or used again
+         - bands (int): Number of bands, and so of worker processes
+         - seed (int): If given, band b's random numbers are seeded with seed + b, so that runs
+            can be repeated
+        """
+
+        config = tank.config
+        self.config = config
+        self.width = config.tank_width
+        self.height = config.tank_height
+        self.frames_elapsed = tank.frames_elapsed
+        halo = max(config.germ_view_dist, 1)
+        if not 1 <= bands <= self.height // halo:
+            raise ValueError(f'A tank {self.height} rows high can have 1 to '
+                             f'{self.height // halo} bands')
+        # band b owns rows tops[b] up to tops[b + 1]
+        tops = [self.height * b // bands for b in range(bands + 1)]
+        # objects keep their turn order within each band
+        records = [[] for b in range(bands)]
+        for record in tank_snapshot.capture(tank)['objects']:
+            records[bisect_right(tops, record[3]) - 1].append(record)
+        self.memory = SharedMemory(create=True, size=2 * field_size(self.width * self.height))
+        self.workers = []
+        for b in range(bands):
+            history = {'frames_elapsed':tank.frames_elapsed, 'next_id':tank.next_id + b}
+            snapshot = tank_snapshot.encode({'history':history, 'objects':records[b]},
+                                            MEMORY_SIZE)
+            conn, child_conn = Pipe()
+            process = Process(target=run_band, daemon=True,
+                              args=(child_conn, self.memory.name, b, tops, snapshot,
+                                    config.to_dict(), None if seed is None else seed + b))
+            process.start()
+            self.workers.append((process, conn))
+        for process, conn in self.workers:
+            conn.recv()
+        # handovers and ghost damage waiting to be reconciled by each band
+        self.incoming = [([], []) for b in range(bands)]
+        self.germ_counts = [0] * bands
+
+    def update(self, burst_turn):
+        """Gives all germs in every band a turn, as GermTank.update does"""
+
+        self.send(('frame', burst_turn))
+        outputs = [conn.recv() for process, conn in self.workers]
+        self.germ_counts = [output[2] for output in outputs]
+        # what a band hands up goes to the band above, and what it hands down to the one below;
+        # arrivals from above come first, then from below
+        bands = len(self.workers)
+        self.incoming = []
+        for b in range(bands):
+            arrivals = []
+            damage = []
+            if b > 0:
+                arrivals += outputs[b - 1][1][0]
+                damage += outputs[b - 1][1][1]
+            if b < bands - 1:
+                arrivals += outputs[b + 1][0][0]
+                damage += outputs[b + 1][0][1]
+            self.incoming.append((arrivals, damage))
+        self.frames_elapsed += 1
+
+    def send(self, command):
+        """Sends a command to every band, along with its incoming handovers and damage"""
+
+        for (process, conn), (arrivals, damage) in zip(self.workers, self.incoming):
+            conn.send(command + (arrivals, damage))
+        self.incoming = [([], []) for b in self.workers]
+
+    def get_stats(self):
+        """Returns a dict with frames_elapsed and germ_count, as in GermTank.get_stats"""
+
+        return {'frames_elapsed':self.frames_elapsed, 'germ_count':sum(self.germ_counts)}
+
+    def to_tank(self):
+        """Returns (GermTank): A single tank holding every band's objects"""
+
+        self.send(('capture',))
+        objects = []
+        next_id = 0
+        for process, conn in self.workers:
+            data = tank_snapshot.decode(conn.recv())
+            objects += data['objects']
+            next_id = max(next_id, data['history']['next_id'])
+        history = {'frames_elapsed':self.frames_elapsed, 'next_id':next_id,
+                   'config':self.config.to_dict()}
+        objects.sort(key=lambda record: record[0])
+        return GermTank(snapshot={'history':history, 'objects':objects})
+
+    def to_snapshot(self):
+        """Dumps the whole tank to a compact binary snapshot (see tank_snapshot)"""
+
+        return self.to_tank().to_snapshot()
+
+    def close(self):
+        """Stops the band workers and frees the shared memory"""
+
+        for process, conn in self.workers:
+            conn.send(None)
+            process.join()
+        self.memory.close()
+        self.memory.unlink()
+
+class Band:
+    """One band of a BandedTank: a GermTank owning some rows, and its halo of ghosts"""
+
+    def __init__(self, memory, band, tops, snapshot, config, seed=None):
+        """Class constructor.
+
+        Params:
+         - memory (SharedMemory): The edge rows shared by all bands
+         - band (int): Index of this band
+         - tops (list of int): The first row of each band, plus the height of the tank
+         - snapshot (bytes): This band's objects, as encoded by tank_snapshot
+         - config (dict): TankConfig.to_dict of the whole tank
+         - seed (int): Seed for the band's random numbers (see GermTank.seed_random)
+        """
+
+        world = TankConfig.from_dict(config)
+        width = world.tank_width
+        halo = max(world.germ_view_dist, 1)
+        top = tops[band]
+        bottom = tops[band + 1]
+        halo_above = min(halo, top)
+        halo_below = min(halo, world.tank_height - bottom)
+        height = halo_above + bottom - top + halo_below
+        # the band's tank is a window onto rows top - halo_above onwards, with food density
+        # scaled so that only the band's own rows count towards it
+        local = TankConfig.from_dict(dict(config, tank_height=height,
+                                          max_food_density=world.max_food_density
+                                          * (bottom - top) / height))
+        self.offset = top - halo_above
+        data = tank_snapshot.decode(snapshot)
+        data['history']['config'] = local.to_dict()
+        data['objects'] = [record[:3] + (record[3] - self.offset,) + record[4:]
+                           for record in data['objects']]
+        self.tank = GermTank(snapshot=data, seed=seed)
+        self.tank.id_step = len(tops) - 1
+        upkeep_by_row, brightness_by_row = get_row_tables(world)
+        self.tank.upkeep_by_row = upkeep_by_row[self.offset:self.offset + height]
+        self.tank.brightness_by_row = brightness_by_row[self.offset:self.offset + height]
+        self.width = width
+        # local rows of the halo above, of this band's own rows and of the halo below
+        self.above = range(0, halo_above)
+        self.rows = range(halo_above, height - halo_below)
+        self.below = range(height - halo_below, height)
+        # local rows that the bands above and below see as their halo
+        self.edges = [y for y in range(halo_above, halo_above + halo) if halo_above] + \
+                     [y for y in range(height - halo_below - halo, height - halo_below)
+                      if halo_below]
+        self.fields = open_fields(memory, width * world.tank_height)
+
+    def frame(self, burst_turn, parity, arrivals, damage):
+        """Runs a frame of this band.
+
+        Params:
+         - burst_turn (bool): As for GermTank.update
+         - parity (int): 0 or 1; the shared edge rows alternate between two buffers, so that
+            this frame's can be written while neighbours may still be reading the last
+         - arrivals (list of tuple): Handovers from neighbouring bands
+         - damage (list of tuple): Damage done to this band's objects as ghosts
+
+        Returns (tuple): (handed up, handed down, germ count), where each handed part is a list
+            of handovers and a list of damage for that neighbour
+        """
+
+        self.reconcile(arrivals, damage)
+        self.read_halo(1 - parity)
+        self.tank.update(burst_turn)
+        up = self.clear_halo(self.above)
+        down = self.clear_halo(self.below)
+        self.write_edges(parity)
+        return up, down, len(self.tank.objects) - self.tank.food_count
+
+    def reconcile(self, arrivals, damage):
+        """Applies ghost damage from neighbouring bands in the order given, then places
+        handovers in order of id, each at its cell or else the nearest free one in this band.
+        Handovers with nowhere to go are dropped.
+        """
+
+        tank = self.tank
+        objects = tank.objects
+        for obj_id, power in damage:
+            target = objects.get(obj_id)
+            if target is None or not target.alive:
+                continue
+            if power is None:
+                # food eaten
+                target.alive = False
+            else:
+                target.stamina -= power
+                target.pain += power
+                if target.stamina <= 0:
+                    target.alive = False
+        genomes = {}
+        grid = tank.grid
+        neighbours = tank.neighbours
+        first = self.rows.start * self.width
+        end = self.rows.stop * self.width
+        for record in sorted(arrivals, key=lambda record: record[0]):
+            index = (record[3] - self.offset) * self.width + record[2]
+            if grid[index]:
+                # taken by this band's own objects; use the nearest free cell, if any
+                for n in BIRTH_ORDERS[CENTRE]:
+                    cell = neighbours[index][n]
+                    if first <= cell < end and not grid[cell]:
+                        index = cell
+                        break
+                else:
+                    continue
+            if len(record) == 4:
+                obj = Food(record[0], 0, 0)
+                tank.food_count += 1
+            else:
+                obj = tank.germ_from_record(record, genomes)
+            obj.x = index % self.width
+            obj.y = index // self.width
+            tank.fill_cell(index, obj)
+            tank.add_object(obj)
+
+    def read_halo(self, parity):
+        """Fills the halo rows with ghosts of the objects neighbouring bands published"""
+
+        kinds, ids, energy, stamina = self.fields[parity]
+        tank = self.tank
+        width = self.width
+        for y in list(self.above) + list(self.below):
+            base = (y + self.offset) * width
+            for x, kind in enumerate(bytes(kinds[base:base + width])):
+                if kind == FOOD:
+                    tank.fill_cell(y * width + x, Food(ids[base + x], x, y))
+                elif kind == GERM:
+                    ghost = Germ(ids[base + x], True, x, y, energy[base + x], stamina[base + x])
+                    tank.fill_cell(y * width + x, ghost)
+
+    def clear_halo(self, rows):
+        """Empties halo rows after a frame.
+
+        Returns (tuple): (handovers, damage) for the band owning the rows: records of this
+            band's objects that ended up there, and (id, power) for ghosts that were attacked or
+            (id, None) for ghost food that was eaten
+        """
+
+        tank = self.tank
+        objects = tank.objects
+        grid = tank.grid
+        width = self.width
+        handovers = []
+        damage = []
+        for y in rows:
+            for index in range(y * width, (y + 1) * width):
+                obj = grid[index]
+                if obj is None:
+                    continue
+                if objects.get(obj.id) is obj:
+                    if obj.alive:
+                        record = tank_snapshot.capture_object(obj)
+                        if len(record) == 11:
+                            # genomes don't cross processes, but their code does
+                            record = record[:9] + (record[9].code, record[10])
+                        handovers.append(record[:3] + (y + self.offset,) + record[4:])
+                    tank.kill_germ(obj)
+                else:
+                    if obj.brain is None:
+                        if not obj.alive:
+                            damage.append((obj.id, None))
+                    elif obj.pain:
+                        damage.append((obj.id, obj.pain))
+                    tank.empty_cell(index)
+        return handovers, damage
+
+    def write_edges(self, parity):
+        """Publishes the rows neighbouring bands see as their halo"""
+
+        kinds, ids, energy, stamina = self.fields[parity]
+        grid = self.tank.grid
+        width = self.width
+        for y in self.edges:
+            base = (y + self.offset) * width
+            for x, obj in enumerate(grid[y * width:(y + 1) * width]):
+                if obj is None or not obj.alive:
+                    kinds[base + x] = EMPTY
+                elif obj.brain is None:
+                    kinds[base + x] = FOOD
+                    ids[base + x] = obj.id
+                else:
+                    kinds[base + x] = GERM
+                    ids[base + x] = obj.id
+                    energy[base + x] = obj.energy
+                    stamina[base + x] = obj.stamina
+
+    def capture(self):
+        """Returns (bytes): This band's objects as a snapshot, in the whole tank's rows"""
+
+        captured = tank_snapshot.capture(self.tank)
+        captured['objects'] = [record[:3] + (record[3] + self.offset,) + record[4:]
+                               for record in captured['objects']]
+        return tank_snapshot.encode(captured, MEMORY_SIZE)
+
+    def close(self):
+        """Releases this band's views of the shared memory"""
+
+        for fields in self.fields:
+            for field in fields:
+                field.release()
+
+def run_band(conn, memory_name, band, tops, snapshot, config, seed):
+    """Runs one band of a BandedTank in a worker process, taking commands from conn until sent
+    None.
+
+    Commands are ('frame', burst_turn, arrivals, damage), which runs a frame and sends back
+    the result of Band.frame, and ('capture', arrivals, damage), which reconciles and sends back
+    Band.capture. Once set up, the band publishes its edge rows and sends None.
+
+    Params:
+     - conn (Connection): This band's end of a pipe to the BandedTank
+     - memory_name (str): Name of the SharedMemory holding the edge rows
+     - seed (int): Seed for this band's random numbers, or None to seed from the system
+     - other params as for Band
+    """
+
+    # the runner handles interrupts, and stops bands between frames
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # forked processes inherit the runner's random state, which unseeded bands draw seeds from
+    random.seed(seed)
+    memory = SharedMemory(name=memory_name)
+    band_obj = Band(memory, band, tops, snapshot, config, seed)
+    # frame k reads the edges written in frame k - 1 from buffer (k - 1) % 2 and writes its own
+    # to buffer k % 2; these first edges stand in for frame 0's
+    parity = 0
+    band_obj.write_edges(parity)
+    conn.send(None)
+    while True:
+        command = conn.recv()
+        if command is None:
+            break
+        if command[0] == 'frame':
+            parity = 1 - parity
+            conn.send(band_obj.frame(command[1], parity, command[2], command[3]))
+        else:
+            band_obj.reconcile(command[1], command[2])
+            conn.send(band_obj.capture())
+    band_obj.close()
+    memory.close()
+
+def field_size(cells):
+    """Returns (int): Bytes of shared memory needed for one buffer of edge rows"""
+
+    return (cells + 7) // 8 * 8 + cells * 24
+
+def open_fields(memory, cells):
+    """Returns (list of tuple): For each of the two buffers of edge rows in memory, views of
+    the kinds (B), ids (q), energy (d) and stamina (d) of every cell of the tank"""
+
+    buffers = []
+    for parity in range(2):
+        start = parity * field_size(cells)
+        kinds_size = (cells + 7) // 8 * 8
+        fields = [memory.buf[start:start + cells].cast('B')]
+        start += kinds_size
+        for typecode in 'qdd':
+            fields.append(memory.buf[start:start + cells * 8].cast(typecode))
+            start += cells * 8
+        buffers.append(tuple(fields))
+    return buffers
+
+class BandedRunner:
+    """Runs the autosaved tank, or a new one, split into bands in parallel processes"""
+
+    def __init__(self, bands=None, config=None):
+        """Class constructor.
+
+        Params:
+         - bands (int): Number of bands; defaults to the number of CPUs, or as many as the
+            tank's height allows
+         - config (TankConfig): Parameters for a new tank, if there's no autosave
+        """
+
+        self.stop_requested = False
+        signal.signal(signal.SIGINT, self.stop_execution)
+        signal.signal(signal.SIGTERM, self.stop_execution)
+        try:
+            tank = GermTank(snapshot=load_checkpoint(BANDS_AUTOSAVE), config=config)
+        except FileNotFoundError:
+            tank = GermTank(config=config)
+        most = tank.height // max(tank.view_dist, 1)
+        self.tank = BandedTank(tank, min(bands or os.cpu_count(), most))
+
+    def stop_execution(self, signum, frame):
+        """Called when the process receives a stop signal"""
+
+        self.stop_requested = True
+
+    def run(self):
+        """Runs the tank until stopped, saving it and printing stats periodically"""
+
+        frames = 0
+        start = time_ns()
+        turns = 0
+        while not self.stop_requested:
+            turns += self.tank.get_stats()['germ_count']
+            self.tank.update(False)
+            frames += 1
+            if frames % BAND_STATS_INTERVAL == 0:
+                elapsed = (time_ns() - start) / 1000000000.0
+                print("BANDED STATS")
+                print(f'Frames elapsed: {self.tank.frames_elapsed / 1000}k')
+                print(f'Bands: {len(self.tank.workers)}')
+                print(f'Germs per band: {self.tank.germ_counts}')
+                print(f'Frames per second: {BAND_STATS_INTERVAL / elapsed}')
+                print(f'Turns per second: {turns / elapsed}')
+                print('==================================================')
+                start = time_ns()
+                turns = 0
+            if frames % BAND_CHECKPOINT_INTERVAL == 0:
+                self.save()
+        self.save()
+        self.tank.close()
+
+    def save(self):
+        """Saves the whole tank to BANDS_AUTOSAVE"""
+
+        tmp = write_tmp(BANDS_AUTOSAVE, self.tank.to_snapshot())
+        os.replace(tmp, BANDS_AUTOSAVE)
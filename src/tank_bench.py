@@ -0,0 +1,263 @@
+"""Benchmarks of tank throughput on fixed, seeded scenarios, and comparison of their results"""
+
+import argparse
+import json
+import platform
+import resource
+import sys
+from multiprocessing import Pool
+from random import Random
+from time import perf_counter_ns, strftime
+
+from germ_brain import GermBrain
+from germ_tank import GermTank, TankConfig, STARTING_CODE
+
+BENCH_SEED = 1                  # seed of every scenario's tank, so each run does the same work
+BENCH_FRAMES = 100              # frames timed per scenario
+BENCH_WARMUP = 10               # frames run before timing starts
+BENCH_THRESHOLD = 0.1           # relative change in a metric that compare reports as a regression
+DENSE_FRACTION = 0.25           # fraction of cells the dense scenario fills with germs
+PREDATOR_FRACTION = 0.02        # fraction of cells the predator scenario fills with predators
+EVOLVED_GENOMES = 20            # distinct genomes in the evolved scenario
+EVOLVED_LENGTH = 150            # commands in each evolved genome, at least
+ENDING_COMMANDS = ['mv', 'bir', 'att', 'ret']   # commands that end a germ's run
+LARGE_SCALE = 2                 # the large scenario's tank is this many times as wide and high
+
+# like STARTING_CODE, but attacks the nearest germ instead of eating, moving towards it after
+# an attack fails
+PREDATOR_CODE = [['if', ['>', 'energy', 70], 'm0'],
+                 ['ax', 1],
+                 ['bir'],
+                 ['mrk', 'm0'],
+                 ['ax', ['gix', 0]],
+                 ['ay', ['giy', 0]],
+                 ['if', ['!', 'success'], 'm1'],
+                 ['mv'],
+                 ['mrk', 'm1'],
+                 ['pwr', 5],
+                 ['att']]
+
+# metrics each scenario reports, and whether a higher value is better
+METRICS = {'frames_per_second':True,
+           'turns_per_second':True,
+           'frame_ms_p50':False,
+           'frame_ms_p90':False,
+           'frame_ms_p99':False,
+           'frame_ms_max':False,
+           'peak_rss_mb':False}
+
+def fresh_tank(seed):
+    """Returns a new tank, as a runner starts one"""
+
+    return GermTank(seed=seed)
+
+def dense_tank(seed):
+    """Returns a new tank with a quarter of its cells filled with germs running STARTING_CODE"""
+
+    tank = GermTank(seed=seed)
+    add_germs(tank, Random(seed), DENSE_FRACTION, [STARTING_CODE])
+    return tank
+
+def predator_tank(seed):
+    """Returns a new tank with predators running PREDATOR_CODE among its germs"""
+
+    tank = GermTank(seed=seed)
+    add_germs(tank, Random(seed), PREDATOR_FRACTION, [PREDATOR_CODE])
+    return tank
+
+def evolved_tank(seed):
+    """Returns a new tank whose germs run long genomes, grown by adding random commands to
+    STARTING_CODE
+    """
+
+    tank = GermTank(seed=seed)
+    rng = Random(seed)
+    genomes = []
+    for i in range(EVOLVED_GENOMES):
+        brain = GermBrain(STARTING_CODE, 0, tank.config, rng)
+        while len(brain.code) < EVOLVED_LENGTH:
+            # commands that end the run are left out, so STARTING_CODE still decides the action
+            command = brain.rand_command()
+            if command[0] not in ENDING_COMMANDS:
+                brain.insert_command(rng.randrange(len(brain.code) + 1), command)
+        genomes.append(brain.code)
+    for germ in tank.objects.values():
+        if germ.brain:
+            germ.brain = GermBrain(rng.choice(genomes), 0, tank.config, rng)
+    return tank
+
+def large_tank(seed):
+    """Returns a new tank LARGE_SCALE times as wide and high as the default"""
+
+    config = TankConfig()
+    return GermTank(config=TankConfig(tank_width=config.tank_width * LARGE_SCALE,
+                                      tank_height=config.tank_height * LARGE_SCALE), seed=seed)
+
+# the scenarios, by name, and the function that builds each one's tank from a seed
+SCENARIOS = {'fresh':fresh_tank,
+             'dense':dense_tank,
+             'predator':predator_tank,
+             'evolved':evolved_tank,
+             'large':large_tank}
+
+def add_germs(tank, rng, fraction, codes):
+    """Adds germs to a fraction of the tank's cells, each running one of codes"""
+
+    count = min(int(tank.width * tank.height * fraction), len(tank.free_cells))
+    for index in tank.sample_free_cells(rng, count):
+        brain = GermBrain(rng.choice(codes), 0, tank.config, rng)
+        tank.add_object(tank.add_germ(index % tank.width, index // tank.width, brain))
+
+def count_living_germs(tank):
+    """Returns (int): The number of living germs in the tank, i.e. the turns in its next frame"""
+
+    return sum(1 for obj in tank.objects.values() if obj.brain and obj.alive)
+
+def percentile(ordered, fraction):
+    """Returns the value a fraction of the way through a sorted list, by nearest rank"""
+
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+def run_scenario(name, frames=BENCH_FRAMES, warmup=BENCH_WARMUP, seed=BENCH_SEED):
+    """Builds a scenario's tank and times GermTank.update on it.
+
+    Run each scenario in a process of its own, so that peak_rss_mb is its own.
+
+    Params:
+     - name (str): Scenario name, a key of SCENARIOS
+     - frames (int): Frames to time
+     - warmup (int): Frames to run first, untimed
+     - seed (int): Seed of the tank
+
+    Returns (dict): Each of METRICS, plus:
+     - frames (int): Frames timed
+     - turns (int): Germ turns taken in those frames
+     - germs_start (int): Living germs when timing started
+     - germs_end (int): Living germs when timing ended
+    """
+
+    tank = SCENARIOS[name](seed)
+    for i in range(warmup):
+        tank.update(False)
+    germs_start = germs = count_living_germs(tank)
+    turns = 0
+    timings = []
+    for i in range(frames):
+        start = perf_counter_ns()
+        tank.update(False)
+        timings.append(perf_counter_ns() - start)
+        # germs born this frame take their first turn next frame, so count outside the timing
+        turns += germs
+        germs = count_living_germs(tank)
+    elapsed_ns = max(sum(timings), 1)
+    ordered = sorted(timings)
+    return {'frames':frames,
+            'turns':turns,
+            'germs_start':germs_start,
+            'germs_end':germs,
+            'frames_per_second':frames * 1000000000.0 / elapsed_ns,
+            'turns_per_second':turns * 1000000000.0 / elapsed_ns,
+            'frame_ms_p50':percentile(ordered, 0.5) / 1000000,
+            'frame_ms_p90':percentile(ordered, 0.9) / 1000000,
+            'frame_ms_p99':percentile(ordered, 0.99) / 1000000,
+            'frame_ms_max':ordered[-1] / 1000000,
+            # ru_maxrss is in kilobytes on Linux
+            'peak_rss_mb':resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}
+
+def run_benchmarks(names, frames=BENCH_FRAMES, warmup=BENCH_WARMUP, seed=BENCH_SEED):
+    """Runs scenarios one at a time, each in a fresh process.
+
+    Returns (dict): The settings and machine the benchmarks ran with, and 'scenarios', the
+        results of run_scenario keyed by scenario name
+    """
+
+    results = {'time':strftime('%Y-%m-%dT%H:%M:%S'),
+               'python':platform.python_version(),
+               'machine':platform.machine(),
+               'frames':frames,
+               'warmup':warmup,
+               'seed':seed,
+               'scenarios':{}}
+    for name in names:
+        # maxtasksperchild makes a new process for each scenario, so peak RSS isn't inherited
+        with Pool(1, maxtasksperchild=1) as pool:
+            result = pool.apply(run_scenario, (name, frames, warmup, seed))
+        results['scenarios'][name] = result
+        print(f'{name}: {result["frames_per_second"]:.2f} frames/s, '
+              f'{result["turns_per_second"]:.0f} turns/s, '
+              f'p50 {result["frame_ms_p50"]:.2f} ms, p99 {result["frame_ms_p99"]:.2f} ms, '
+              f'{result["peak_rss_mb"]:.1f} MB', file=sys.stderr)
+    return results
+
+def compare(old, new, threshold=BENCH_THRESHOLD):
+    """Compares two sets of results from run_benchmarks.
+
+    Params:
+     - old (dict): The baseline results
+     - new (dict): The results to check against them
+     - threshold (float): Relative change in a metric, for the worse, reported as a regression
+
+    Returns (list of tuple): (scenario, metric, old value, new value, relative change,
+        regressed) for each metric of each scenario in both sets of results
+    """
+
+    rows = []
+    for name, result in new['scenarios'].items():
+        if name not in old['scenarios']:
+            continue
+        for metric, higher_is_better in METRICS.items():
+            before = old['scenarios'][name][metric]
+            after = result[metric]
+            change = (after - before) / before if before else 0.0
+            worse = -change if higher_is_better else change
+            rows.append((name, metric, before, after, change, worse > threshold))
+    return rows
+
+def main(args):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-o', '--output', help='file to write results to as json, '
+                        'rather than stdout')
+    parser.add_argument('-f', '--frames', type=int, default=BENCH_FRAMES,
+                        help='frames to time per scenario')
+    parser.add_argument('-w', '--warmup', type=int, default=BENCH_WARMUP,
+                        help='frames to run before timing each scenario')
+    parser.add_argument('-s', '--scenario', action='append', choices=list(SCENARIOS),
+                        help='scenario to run; may be repeated, and defaults to all of them')
+    parser.add_argument('-c', '--compare', nargs=2, metavar=('OLD', 'NEW'),
+                        help='compare two results files instead, exiting with status 1 if '
+                        'NEW regressed')
+    parser.add_argument('-t', '--threshold', type=float, default=BENCH_THRESHOLD,
+                        help='relative change compare reports as a regression')
+    options = parser.parse_args(args[1:])
+
+    if options.compare:
+        results = []
+        for path in options.compare:
+            with open(path) as fileobj:
+                results.append(json.load(fileobj))
+        old, new = results
+        regressions = 0
+        for name, metric, before, after, change, regressed in compare(old, new,
+                                                                      options.threshold):
+            flag = 'REGRESSION' if regressed else ''
+            print(f'{name:10} {metric:18} {before:12.3f} {after:12.3f} {change:+8.1%} {flag}')
+            regressions += regressed
+        print(f'{regressions} regressions')
+        for name, result in new['scenarios'].items():
+            if name in old['scenarios'] and result['turns'] != old['scenarios'][name]['turns']:
+                # with the same seed, the same simulation takes the same turns
+                print(f'{name}: took {old["scenarios"][name]["turns"]} turns before and '
+                      f'{result["turns"]} now, so the simulation itself has changed')
+        return 1 if regressions else 0
+
+    results = run_benchmarks(options.scenario or list(SCENARIOS), options.frames,
+                             options.warmup)
+    if options.output:
+        with open(options.output, 'w') as fileobj:
+            json.dump(results, fileobj, indent=1)
+    else:
+        print(json.dumps(results, indent=1))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,209 @@
+"""Periodic checkpoints of a running tank, written in the background"""
+
+import mmap
+import os
+import queue
+import threading
+from operator import itemgetter
+from time import time_ns
+
+import tank_snapshot
+from germ_brain import MEMORY_SIZE
+
+class Checkpointer:
+    """Saves a tank every so many frames without stalling the simulation.
+
+    Each checkpoint captures the tank on the calling thread (see tank_snapshot.capture), which
+    only copies the per-germ state, then leaves encoding and writing to a background thread.
+    Every full_every-th checkpoint is a full snapshot written to path, rotating earlier ones
+    to path.1, path.2, ... The rest are deltas written to path.delta, which record only the
+    objects that changed since the latest full snapshot; germs that existed then are written
+    without their genome, and without their memory if it hasn't changed. Every file is
+    written atomically, so a crash leaves the previous version in place rather than a
+    partial file.
+    """
+
+    def __init__(self, path, interval, full_every=10, keep=3):
+        """Class constructor.
+
+        Params:
+         - path (str): Where to write full snapshots
+         - interval (int): Frames between checkpoints
+         - full_every (int): Write a full snapshot every this many checkpoints
+         - keep (int): Number of earlier full snapshots to keep
+        """
+
+        self.path = path
+        self.interval = interval
+        self.full_every = full_every
+        self.keep = keep
+        self.frames = 0
+        self.checkpoints = 0
+        self.skipped = 0
+        self.cost_ns = 0            # time spent checkpointing on the calling thread...
+        self.cost_frames = 0        # ...over this many frames
+        self.error = None           # last exception raised while writing a checkpoint
+        self.busy = False
+        # records of the latest full snapshot, keyed by id, and the token identifying it
+        self.base = None
+        self.base_token = None
+        self.jobs = queue.Queue()
+        self.thread = threading.Thread(target=self.work, daemon=True)
+        self.thread.start()
+
+    def tick(self, tank):
+        """Called once per frame; starts a checkpoint of the tank every interval frames"""
+
+        self.frames += 1
+        self.cost_frames += 1
+        if self.frames % self.interval:
+            return
+        if self.busy:
+            # the previous checkpoint is still being written; skip this one rather than stall
+            self.skipped += 1
+            return
+        start = time_ns()
+        self.busy = True
+        self.jobs.put((self.checkpoints % self.full_every == 0, tank_snapshot.capture(tank)))
+        self.checkpoints += 1
+        self.cost_ns += time_ns() - start
+
+    def save(self, tank):
+        """Writes a full snapshot of the tank and waits until it's on disk"""
+
+        self.jobs.put((True, tank_snapshot.capture(tank)))
+        self.jobs.join()
+        if self.error:
+            raise self.error
+
+    def take_cost(self):
+        """Returns the time spent checkpointing on the calling thread per frame (in ns) since
+        the last call"""
+
+        cost = self.cost_ns / max(self.cost_frames, 1)
+        self.cost_ns = 0
+        self.cost_frames = 0
+        return cost
+
+    def close(self):
+        """Stops the background thread once any pending checkpoint is written"""
+
+        self.jobs.put(None)
+        self.thread.join()
+
+    def work(self):
+        """Writes checkpoints as they're queued; runs in the background thread"""
+
+        while True:
+            job = self.jobs.get()
+            try:
+                if job is None:
+                    return
+                full, captured = job
+                if full or self.base is None:
+                    self.write_full(captured)
+                else:
+                    self.write_delta(captured)
+                self.error = None
+            except Exception as err:
+                self.error = err
+            finally:
+                self.busy = False
+                self.jobs.task_done()
+
+    def write_full(self, captured):
+        """Writes a full snapshot and makes it the base for later deltas"""
+
+        token = os.urandom(8).hex()
+        captured['history'] = dict(captured['history'], checkpoint=token)
+        tmp = write_tmp(self.path, tank_snapshot.encode(captured, MEMORY_SIZE))
+        for i in range(self.keep, 0, -1):
+            older = f'{self.path}.{i - 1}' if i > 1 else self.path
+            if os.path.exists(older):
+                os.replace(older, f'{self.path}.{i}')
+        os.replace(tmp, self.path)
+        # any delta on disk was based on the previous snapshot
+        if os.path.exists(self.path + '.delta'):
+            os.remove(self.path + '.delta')
+        self.base = {record[0]:record for record in captured['objects']}
+        self.base_token = token
+
+    def write_delta(self, captured):
+        """Writes the changes since the latest full snapshot"""
+
+        objects = []
+        ids = set()
+        for record in captured['objects']:
+            ids.add(record[0])
+            old = self.base.get(record[0])
+            if old is None or len(record) == 4:
+                if record != old:
+                    objects.append(record)
+            elif record != old:
+                # a germ's genome never changes, and its memory often doesn't
+                memory = None if record[10] == old[10] else record[10]
+                objects.append(record[:9] + (None, memory))
+        history = dict(captured['history'], checkpoint_base=self.base_token,
+                       removed=[i for i in self.base if i not in ids])
+        data = tank_snapshot.encode({'history':history, 'objects':objects}, MEMORY_SIZE)
+        os.replace(write_tmp(self.path + '.delta', data), self.path + '.delta')
+
+def write_tmp(path, data):
+    """Writes data to a temporary file next to path and returns its name once it's on disk"""
+
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as fileobj:
+        fileobj.write(data)
+        fileobj.flush()
+        os.fsync(fileobj.fileno())
+    return tmp
+
+def read_snapshot(path):
+    """Returns the decoded snapshot at path"""
+
+    with open(path, 'rb') as fileobj:
+        # left for the garbage collector to close, as a failed decode may still reference it
+        buffer = mmap.mmap(fileobj.fileno(), 0, access=mmap.ACCESS_READ)
+    return tank_snapshot.decode(buffer)
+
+def load_checkpoint(path, keep=3):
+    """Returns the latest checkpoint written by a Checkpointer as tank_snapshot.decode would.
+
+    The full snapshot at path is combined with path.delta if the delta is based on it. If
+    the snapshot at path is missing or unreadable, older rotated ones are tried in turn.
+
+    Raises FileNotFoundError if there's no readable checkpoint.
+    """
+
+    for candidate in [path] + [f'{path}.{i}' for i in range(1, keep + 1)]:
+        try:
+            data = read_snapshot(candidate)
+        except (FileNotFoundError, ValueError):
+            # missing, empty or corrupt
+            continue
+        token = data['history'].pop('checkpoint', None)
+        try:
+            delta = read_snapshot(path + '.delta')
+        except (FileNotFoundError, ValueError):
+            delta = None
+        if delta and token and delta['history'].pop('checkpoint_base') == token:
+            data = apply_delta(data, delta)
+        return data
+    raise FileNotFoundError(f'No checkpoint found at {path}')
+
+def apply_delta(data, delta):
+    """Returns the decoded full snapshot data updated with the decoded delta"""
+
+    records = {record[0]:record for record in data['objects']}
+    for obj_id in delta['history'].pop('removed'):
+        del records[obj_id]
+    for record in delta['objects']:
+        if len(record) == 11 and (record[9] is None or record[10] is None):
+            old = records[record[0]]
+            record = record[:9] + (old[9] if record[9] is None else record[9],
+                                   old[10] if record[10] is None else record[10])
+        records[record[0]] = record
+    # objects take turns in the order they were added, which is the order of their ids
+    return {'history':delta['history'],
+            'memory_size':data['memory_size'],
+            'objects':sorted(records.values(), key=itemgetter(0))}
@@ -0,0 +1,251 @@
+"""Runs several tanks in parallel processes, with germs migrating between them"""
+
+import os
+import random
+import signal
+from multiprocessing import Pipe, Process
+from struct import Struct
+from time import time_ns
+
+from germ_tank import GermTank, TankConfig
+from tank_checkpoint import write_tmp
+from tank_snapshot import align
+
+ISLANDS_AUTOSAVE = 'islands.tank'   # checkpoint of every island, which runners resume from
+MIGRATION_INTERVAL = 500            # frames each island runs between migrations
+MIGRANTS = 5                        # germs each island sends to the next at each migration
+ISLAND_CHECKPOINT_INTERVAL = 5000   # frames between checkpoints of every island
+ISLAND_STATS_INTERVAL = 10000       # frames between printing stats
+
+# an islands checkpoint is a header, a table of entries and each island's tank snapshot,
+# aligned to 8 bytes like the sections of a snapshot
+ARCHIVE_MAGIC = b'GISL'
+ARCHIVE_VERSION = 1
+ARCHIVE_HEADER = Struct('<4sHI')    # magic, version, island count
+ARCHIVE_ENTRY = Struct('<QQ')       # offset and length of an island's snapshot
+
+class IslandRunner:
+    """Runs a number of independent tanks, or islands, each in its own process.
+
+    Islands run migration_interval frames at a time. In between, each one sends a sample of its
+    germs to the next island round a ring, so good genomes spread between islands without
+    any island depending on another while it runs. Every island is checkpointed at the same
+    frame, so they resume together.
+    """
+
+    def __init__(self, count=None, config=None, migration_interval=MIGRATION_INTERVAL,
+                 migrants=MIGRANTS, path=ISLANDS_AUTOSAVE):
+        """Class constructor.
+
+        Params:
+         - count (int): Number of islands; defaults to the number saved at path if there's a
+            checkpoint, otherwise the number of CPUs
+         - config (TankConfig): Parameters for new islands; checkpointed islands keep their own
+         - migration_interval (int): Frames islands run between migrations
+         - migrants (int): Germs each island sends to the next at each migration
+         - path (str): Where to checkpoint the islands, and resume them from
+        """
+
+        self.stop_requested = False
+        signal.signal(signal.SIGINT, self.stop_execution)
+        signal.signal(signal.SIGTERM, self.stop_execution)
+        self.migration_interval = migration_interval
+        self.migrants = migrants
+        self.path = path
+        try:
+            snapshots = load_islands(path)
+        except FileNotFoundError:
+            snapshots = []
+        count = count or len(snapshots) or os.cpu_count()
+        config = (config or TankConfig()).to_dict()
+        self.islands = []
+        for i in range(count):
+            conn, child_conn = Pipe()
+            snapshot = snapshots[i] if i < len(snapshots) else None
+            process = Process(target=run_island, args=(child_conn, snapshot, config), daemon=True)
+            process.start()
+            self.islands.append((process, conn))
+        self.reset_stats()
+
+    def stop_execution(self, signum, frame):
+        """Called when the process receives a stop signal"""
+
+        self.stop_requested = True
+
+    def reset_stats(self):
+        """Clears the turns and times gathered for print_stats"""
+
+        self.turns = [0] * len(self.islands)
+        self.elapsed_ns = [0] * len(self.islands)
+        self.wall_ns = 0
+
+    def step(self, frames, immigrants, save, pending=None):
+        """Runs every island for a number of frames and gathers the results.
+
+        Params:
+         - frames (int): Frames to run
+         - immigrants (list of bytes): Germs to add to each island first, as returned by
+            GermTank.emigrate, or None
+         - save (bool): Whether each island should also return a snapshot of itself
+         - pending (list of bytes): Snapshots from an earlier step to checkpoint while the
+            islands run
+
+        Returns (list of tuple): For each island, (turns, elapsed_ns, frames_elapsed,
+            germ_count, emigrants, snapshot), as sent by run_island
+        """
+
+        migrants = self.migrants if frames else 0
+        for (process, conn), batch in zip(self.islands, immigrants):
+            conn.send((frames, batch, migrants, save))
+        if pending:
+            self.write(pending)
+        return [conn.recv() for process, conn in self.islands]
+
+    def run(self):
+        """Runs the islands until stopped, migrating, checkpointing and printing stats"""
+
+        immigrants = [None] * len(self.islands)
+        pending = None
+        checkpoint_frames = 0
+        stats_frames = 0
+        while not self.stop_requested:
+            checkpoint_frames += self.migration_interval
+            save = checkpoint_frames >= ISLAND_CHECKPOINT_INTERVAL
+            if save:
+                checkpoint_frames = 0
+            start = time_ns()
+            results = self.step(self.migration_interval, immigrants, save, pending)
+            self.wall_ns += time_ns() - start
+            for i, (turns, elapsed_ns, *rest) in enumerate(results):
+                self.turns[i] += turns
+                self.elapsed_ns[i] += elapsed_ns
+            # each island's emigrants go to the next island round the ring
+            immigrants = [results[i - 1][4] for i in range(len(results))]
+            pending = [result[5] for result in results] if save else None
+            stats_frames += self.migration_interval
+            if stats_frames >= ISLAND_STATS_INTERVAL:
+                stats_frames = 0
+                self.print_stats(results)
+        self.close(immigrants)
+
+    def print_stats(self, results):
+        """Prints turns per second of each island and of all of them together"""
+
+        print("ISLAND STATS")
+        print(f'Frames elapsed: {results[0][2] / 1000}k')
+        for i, result in enumerate(results):
+            tps = self.turns[i] * 1000000000.0 / max(self.elapsed_ns[i], 1)
+            print(f'Island {i}: {result[3]} germs, {tps} turns per second')
+        tps = sum(self.turns) * 1000000000.0 / max(self.wall_ns, 1)
+        print(f'Aggregate turns per second: {tps}')
+        print('==================================================')
+        self.reset_stats()
+
+    def write(self, snapshots):
+        """Checkpoints the islands, keeping the previous checkpoint as path.1"""
+
+        tmp = write_tmp(self.path, pack_islands(snapshots))
+        if os.path.exists(self.path):
+            os.replace(self.path, self.path + '.1')
+        os.replace(tmp, self.path)
+
+    def close(self, immigrants):
+        """Delivers any migrants still in transit, saves every island and stops them"""
+
+        results = self.step(0, immigrants, True)
+        self.write([result[5] for result in results])
+        for process, conn in self.islands:
+            conn.send(None)
+            process.join()
+
+def run_island(conn, snapshot, config):
+    """Runs one island in a worker process, taking commands from conn until sent None.
+
+    Each command is (frames, immigrants, migrants, save): the island adds the immigrants (as
+    returned by GermTank.emigrate, or None), runs the frames, then sends back (turns,
+    elapsed_ns, frames_elapsed, germ_count, emigrants, snapshot), where emigrants holds up to
+    migrants of its germs and snapshot is the island's snapshot if save is set, else None.
+
+    Params:
+     - conn (Connection): This island's end of a pipe to the IslandRunner
+     - snapshot (bytes): The island's snapshot, or None for a new tank
+     - config (dict): TankConfig.to_dict of the parameters for a new tank
+    """
+
+    # the runner handles interrupts, and stops islands between migrations
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # forked processes inherit the runner's random state, but each island needs its own
+    random.seed()
+    tank = GermTank(snapshot=snapshot, config=TankConfig.from_dict(config))
+    while True:
+        command = conn.recv()
+        if command is None:
+            return
+        frames, immigrants, migrants, save = command
+        if immigrants:
+            tank.immigrate(immigrants)
+        germ_count = count_germs(tank)
+        start = time_ns()
+        for i in range(frames):
+            tank.update(False)
+        elapsed_ns = time_ns() - start
+        # like TankRunner's turns per second, this assumes every germ took a turn each frame;
+        # averaging the populations at either end allows for growth or decline in between
+        turns = (germ_count + count_germs(tank)) * frames // 2
+        emigrants = tank.emigrate(migrants) if migrants else None
+        conn.send((turns, elapsed_ns, tank.frames_elapsed, count_germs(tank), emigrants,
+                   tank.to_snapshot() if save else None))
+
+def count_germs(tank):
+    """Returns (int): The number of germs in the tank, dead or alive"""
+
+    return sum(1 for obj in tank.objects.values() if obj.brain)
+
+def pack_islands(snapshots):
+    """Returns (bytes): An islands checkpoint holding each of the given tank snapshots"""
+
+    out = bytearray(ARCHIVE_HEADER.pack(ARCHIVE_MAGIC, ARCHIVE_VERSION, len(snapshots)))
+    offset = align(len(out) + ARCHIVE_ENTRY.size * len(snapshots))
+    for snapshot in snapshots:
+        out += ARCHIVE_ENTRY.pack(offset, len(snapshot))
+        offset = align(offset + len(snapshot))
+    for snapshot in snapshots:
+        out += bytes(align(len(out)) - len(out))
+        out += snapshot
+    return bytes(out)
+
+def unpack_islands(buffer):
+    """Returns (list of bytes): The tank snapshots in an islands checkpoint"""
+
+    view = memoryview(buffer)
+    if len(view) < ARCHIVE_HEADER.size:
+        raise ValueError('Islands checkpoint is truncated')
+    magic, version, count = ARCHIVE_HEADER.unpack_from(view)
+    if magic != ARCHIVE_MAGIC:
+        raise ValueError('Not an islands checkpoint')
+    if version != ARCHIVE_VERSION:
+        raise ValueError(f'Unsupported islands checkpoint version {version}')
+    snapshots = []
+    for i in range(count):
+        offset, length = ARCHIVE_ENTRY.unpack_from(view, ARCHIVE_HEADER.size
+                                                   + ARCHIVE_ENTRY.size * i)
+        if offset + length > len(view):
+            raise ValueError('Islands checkpoint is truncated')
+        snapshots.append(bytes(view[offset:offset + length]))
+    return snapshots
+
+def load_islands(path):
+    """Returns the snapshots in the islands checkpoint at path, or at path.1 if that's
+    unreadable.
+
+    Raises FileNotFoundError if there's no readable checkpoint.
+    """
+
+    for candidate in [path, path + '.1']:
+        try:
+            with open(candidate, 'rb') as fileobj:
+                return unpack_islands(fileobj.read())
+        except (FileNotFoundError, ValueError):
+            # missing, empty or corrupt
+            continue
+    raise FileNotFoundError(f'No islands checkpoint found at {path}')
@@ -0,0 +1,97 @@
+"""Optional instrumentation of where GermTank.update spends its time"""
+
+import json
+from time import perf_counter_ns
+
+from germ_brain import RunCounts
+
+# phases of GermTank.update, in the order they happen
+PHASES = ['upkeep',          # energy upkeep, stamina regen and random deaths
+          'dine',            # eating adjacent food
+          'view',            # filling in the germ's senses (its view is scanned during 'brain')
+          'brain',           # running germ code, including any view scans it triggers
+          'request',         # carrying out the action requested by germ code
+          'food_walk',       # moving food particles
+          'sweep',           # removing dead objects and adding newborn germs
+          'regrowth']        # spawning new food
+
+COUNTERS = ['turns',         # germ turns taken, i.e. brains run
+            'instructions',  # germ code commands executed
+            'cells_scanned', # view cells examined
+            'move',          # move actions requested
+            'birth',         # birth actions requested
+            'attack',        # attack actions requested
+            'halt',          # brains halted by the execution limit
+            'births',        # germs born
+            'deaths',        # objects removed, including eaten food
+            'food_added']    # food particles spawned
+
+class TankProfiler:
+    """Accumulates time spent in each phase of GermTank.update, and counts of notable events.
+
+    Assign one to GermTank.profiler to enable it. With no profiler, update only pays for a few
+    falsy checks per germ turn.
+    """
+
+    def __init__(self, log_path=None, count_runs=False):
+        """Class constructor.
+
+        Params:
+         - log_path (str): If given, write_log appends stats to this file as json lines
+         - count_runs (bool): Whether to also tally every command and operator germ code
+            executes (see GermBrain.run_counted). This slows the 'brain' phase considerably.
+        """
+
+        self.log_path = log_path
+        self.count_runs = count_runs
+        self.reset()
+
+    def reset(self):
+        """Clears all timings and counts"""
+
+        self.frames = 0
+        self.phase_ns = dict.fromkeys(PHASES, 0)
+        self.counts = dict.fromkeys(COUNTERS, 0)
+        self.run_counts = RunCounts() if self.count_runs else None
+
+    def lap(self, phase, start):
+        """Adds the time since start to phase and returns the current time, to start the next"""
+
+        now = perf_counter_ns()
+        self.phase_ns[phase] += now - start
+        return now
+
+    def count_turn(self, brain, view, request):
+        """Records a germ turn: the instructions it ran, the cells it saw and what it requested"""
+
+        counts = self.counts
+        counts['turns'] += 1
+        counts['instructions'] += brain.executed
+        counts['cells_scanned'] += view.scanned
+        if request.action:
+            counts[request.action] += 1
+
+    def get_stats(self):
+        """Returns (dict): Keys are:
+         - frames (int): Frames profiled
+         - ms_per_frame (dict): Average milliseconds per frame spent in each phase
+         - counts (dict): Total of each counter over all frames profiled
+         - runs (dict): RunCounts.to_dict of all germ code run, if count_runs is set
+        """
+
+        frames = max(self.frames, 1)
+        stats = {'frames':self.frames,
+                 'ms_per_frame':{phase:ns / frames / 1000000
+                                 for phase, ns in self.phase_ns.items()},
+                 'counts':dict(self.counts)}
+        if self.run_counts:
+            stats['runs'] = self.run_counts.to_dict()
+        return stats
+
+    def write_log(self, frames_elapsed):
+        """Appends the current stats to the log file, if there is one"""
+
+        if self.log_path:
+            with open(self.log_path, 'a') as fileobj:
+                fileobj.write(json.dumps({'frames_elapsed':frames_elapsed, **self.get_stats()}))
+                fileobj.write('\n')
@@ -9,11 +9,42 @@ import _thread
 from itertools import chain
 from pprint import pprint
 
-from germ_tank import GermTank, TANK_WIDTH, TANK_HEIGHT
+from germ_tank import GermTank
+from tank_bands import BandedRunner
+from tank_checkpoint import Checkpointer, load_checkpoint
+from tank_islands import IslandRunner
+from tank_profiler import TankProfiler
+
+AUTOSAVE = 'autosave.tank'          # binary snapshot that runners resume from and save to
+AUTOSAVE_JSON = 'autosave.json'     # json save imported if there's no snapshot yet
+CHECKPOINT_INTERVAL = 1000          # frames between background checkpoints to AUTOSAVE
+CHECKPOINT_FULL_EVERY = 10          # every this many checkpoints is a full snapshot, not a delta
+CHECKPOINT_KEEP = 3                 # number of earlier full snapshots kept as AUTOSAVE.1, ...
+PROFILE = False                     # whether to time each phase of a frame and print it with stats
+PROFILE_LOG = None                  # file that profiling stats are also appended to, if set
+PROFILE_RUNS = False                # whether profiling also tallies the germ code commands and
+                                    # operators executed; slows germ code down considerably
+
+def load_tank(config=None):
+    """Returns the autosaved tank, or a new one if there's no autosave.
+
+    Params:
+     - config (TankConfig): Parameters for a new tank; an autosaved tank keeps its own
+    """
+
+    try:
+        return GermTank(snapshot=load_checkpoint(AUTOSAVE, CHECKPOINT_KEEP), config=config)
+    except FileNotFoundError:
+        pass
+    try:
+        with open(AUTOSAVE_JSON) as fileobj:
+            return GermTank(fileobj.read(), config=config)
+    except FileNotFoundError:
+        return GermTank(config=config)
 
 def paint(image, pixels, scale=1):
     image.put(" ".join(["{" + " ".join(chain(*zip(*[row for _ in range(scale)]))) + "}" for row in pixels for _ in range(scale)]),
-              (0, 0, TANK_WIDTH * scale, TANK_HEIGHT * scale))
+              (0, 0, len(pixels[0]) * scale, len(pixels) * scale))
 
 class TankRunner(ABC):
     """Base class for tank runners"""
@@ -28,6 +59,10 @@ class TankRunner(ABC):
         signal.signal(signal.SIGINT, self.stop_execution)
         signal.signal(signal.SIGTERM, self.stop_execution)
         self.tank = germ_tank
+        if PROFILE:
+            self.tank.profiler = TankProfiler(PROFILE_LOG, PROFILE_RUNS)
+        self.checkpointer = Checkpointer(AUTOSAVE, CHECKPOINT_INTERVAL, CHECKPOINT_FULL_EVERY,
+                                         CHECKPOINT_KEEP)
 
     def stop_execution(self, signum, frame):
         """Called when the process receives a stop signal"""
@@ -45,6 +80,26 @@ class TankRunner(ABC):
         print(f'Energy density: {stats["energy_density"]}')
         print(f'Frames per second: {fps}')
         print(f'Turns per second: {tps}')
+        print(f'Checkpoint cost per frame: {self.checkpointer.take_cost() / 1000000} ms'
+              f' ({self.checkpointer.skipped} skipped)')
+        if self.checkpointer.error:
+            print(f'Checkpoint failed: {self.checkpointer.error}')
+        profiler = self.tank.profiler
+        if profiler:
+            profile = profiler.get_stats()
+            print(f'Profiled frames: {profile["frames"]}')
+            for phase, ms in profile['ms_per_frame'].items():
+                print(f'  {phase}: {ms:.3f} ms per frame')
+            for name, count in profile['counts'].items():
+                print(f'  {name}: {count}')
+            if 'runs' in profile:
+                runs = profile['runs']
+                print(f'  Instructions per run: {runs["instructions"] / max(runs["runs"], 1)}')
+                print(f'  Halted runs: {runs["halts"]} of {runs["runs"]}')
+                print(f'  Commands: {runs["commands"]}')
+                print(f'  Operators: {runs["operators"]}')
+            profiler.write_log(stats['frames_elapsed'])
+            profiler.reset()
         print('==================================================')
 
     def run(self):
@@ -56,6 +111,7 @@ class TankRunner(ABC):
                 self.do_frame()
                 elapsed = time_ns() - start_time
                 self.frames_executed += 1
+                self.checkpointer.tick(self.tank)
                 # On frame 100, start gathering timing data, then print stats when 50 entries gathered
                 if self.frames_executed % 10000 == 100 or self.frame_timings:
                     self.frame_timings.append(elapsed)
@@ -64,6 +120,11 @@ class TankRunner(ABC):
                         self.frame_timings = []
         self.close()
 
+    def save(self):
+        """Autosaves the tank as a full snapshot, once any checkpoint in progress is written"""
+
+        self.checkpointer.save(self.tank)
+
     def toggle_pause(self, event):
         """Pauses or unpauses the tank"""
 
@@ -80,14 +141,14 @@ class TankRunner(ABC):
 class HeadlessRunner(TankRunner):
     """Allows for running a tank without visual feedback for faster performance"""
 
-    def __init__(self):
-        """Class constructor"""
+    def __init__(self, config=None):
+        """Class constructor.
 
-        try:
-            with open('autosave.json') as fileobj:
-                super().__init__(GermTank(fileobj.read()))
-        except FileNotFoundError:
-            super().__init__(GermTank())
+        Params:
+         - config (TankConfig): Parameters for a new tank, if there's no autosave
+        """
+
+        super().__init__(load_tank(config))
 
     def do_frame(self):
         """Called every frame"""
@@ -97,15 +158,20 @@ class HeadlessRunner(TankRunner):
     def close(self):
         """Called when the app closes"""
 
-        with open('autosave.json', 'w') as fileobj:
-            fileobj.write(self.tank.to_json())
+        self.save()
 
 class VisualRunner(TankRunner):
     """Allows for running a tank with visual feedback"""
 
-    def __init__(self, root=None):
-        """Class constructor"""
+    def __init__(self, root=None, config=None):
+        """Class constructor.
+
+        Params:
+         - root (tk.Tk): The window to show the tank in
+         - config (TankConfig): Parameters for a new tank, if there's no autosave
+        """
 
+        tank = load_tank(config)
         self.scale = 3
         self.root = root
         self.root.protocol("WM_DELETE_WINDOW", self.close)
@@ -114,15 +180,11 @@ class VisualRunner(TankRunner):
         self.frame = tk.Frame(self.root)
         self.frame.pack()
         self.photo = tk.PhotoImage(master=self.frame,
-                                   width=TANK_WIDTH * self.scale,
-                                   height=TANK_HEIGHT * self.scale)
+                                   width=tank.width * self.scale,
+                                   height=tank.height * self.scale)
         self.label = tk.Label(master=self.frame, image=self.photo)
         self.label.pack()
-        try:
-            with open('autosave.json') as fileobj:
-                super().__init__(GermTank(fileobj.read()))
-        except FileNotFoundError:
-            super().__init__(GermTank())
+        super().__init__(tank)
 
     def do_frame(self):
         """Called every frame"""
@@ -142,8 +204,7 @@ class VisualRunner(TankRunner):
         except tk.TclError:
             # app already destroyed
             self.stop_requested = True
-        with open('autosave.json', 'w') as fileobj:
-            fileobj.write(self.tank.to_json())
+        self.save()
 
     def inspect(self, event):
         """Inspects the clicked cell when the tank is paused"""
@@ -151,18 +212,25 @@ class VisualRunner(TankRunner):
         if self.pause:
             x = int(event.x / self.scale - 1)
             y = int(event.y / self.scale - 1)
-            try:
-                germ = self.tank.tank[y][x]
-            except IndexError:
+            if not (0 <= x < self.tank.width and 0 <= y < self.tank.height):
                 return
-            if germ and germ['brain']:
+            germ = self.tank.get_cell(x, y)
+            if germ and germ.brain:
                 print("\nGERM CODE:")
-                pprint(germ['brain'].code)
+                pprint(germ.brain.code)
 
 def main(args):
     if len(args) > 1 and args[1] == "-H":
         runner = HeadlessRunner()
         runner.run()
+    elif len(args) > 1 and args[1] == "-B":
+        # one tank split into bands in parallel processes, e.g. -B 8; defaults to one per CPU
+        runner = BandedRunner(int(args[2]) if len(args) > 2 else None)
+        runner.run()
+    elif len(args) > 1 and args[1] == "-I":
+        # islands in parallel processes, e.g. -I 8; defaults to one per CPU
+        runner = IslandRunner(int(args[2]) if len(args) > 2 else None)
+        runner.run()
     else:
         root = tk.Tk()
         runner = VisualRunner(root=root)
@@ -0,0 +1,253 @@
+"""Compact binary snapshots of a tank, as an alternative to GermTank.to_json
+
+A snapshot is a fixed header, a table of sections and the sections themselves, each aligned to
+8 bytes so they can be sliced straight out of an mmap. Objects are stored column-wise in typed
+arrays, every distinct genome is stored once and referenced by index, and germ memory is
+packed as (register, value) pairs of its non-zero registers only. All values are little-endian.
+
+Sections, in order:
+ - genome offsets (Q): start of each genome in the genome blob, plus the end of the last
+ - genome blob: each genome's code as compact utf-8 json
+ - object ids (q), x (I), y (I) and flags (B) for every object, in turn order
+ - energy (d), stamina (d), pain (q), genome index (I) and memory pair count (H) for every
+   germ, in turn order
+ - memory registers (H) and values (q) of all germs' pairs, one germ after another
+ - big memory values: json list of the values that don't fit in a q, in the order they occur
+   (their slots in the values section hold BIG_VALUE)
+ - history: json dict of any tank history beyond frames_elapsed and next_id
+"""
+
+import json
+import sys
+from array import array
+from struct import Struct
+
+MAGIC = b'GTNK'
+VERSION = 1
+
+HEADER = Struct('<4sHHQQIIIII')     # magic, version, flags, frames_elapsed, next_id,
+                                    # object count, germ count, genome count, memory size,
+                                    # section count
+SECTION = Struct('<QQ')             # offset and length of a section in bytes
+SECTIONS = [('genome_offsets', 'Q'),
+            ('genome_blob', None),
+            ('ids', 'q'),
+            ('xs', 'I'),
+            ('ys', 'I'),
+            ('flags', 'B'),
+            ('energy', 'd'),
+            ('stamina', 'd'),
+            ('pain', 'q'),
+            ('genomes', 'I'),
+            ('memory_counts', 'H'),
+            ('registers', 'H'),
+            ('values', 'q'),
+            ('big_values', None),
+            ('history', None)]
+
+# object flags
+ALIVE = 1
+FOOD = 2
+SUCCESS = 4
+BURST = 8
+
+# stands in for memory values outside the range of a signed 64-bit int
+BIG_VALUE = -2 ** 63
+
+# used by delta checkpoints (see tank_checkpoint) for germs whose genome or memory hasn't
+# changed since the full snapshot the delta is based on
+KEEP_GENOME = 2 ** 32 - 1
+KEEP_MEMORY = 2 ** 16 - 1
+
+def capture(tank):
+    """Takes a cheap copy of the tank's state that encode can serialize later.
+
+    Genomes are immutable, so they are referenced rather than copied; everything else that
+    changes from frame to frame is copied. The result doesn't reference any mutable tank state,
+    so it can be encoded in another thread while the tank carries on.
+
+    Returns (dict): Keys are:
+     - history (dict): frames_elapsed, next_id and any other tank history
+     - objects (list of tuple): (id, alive, x, y) for food particles and
+        (id, alive, x, y, energy, stamina, success, burst, pain, genome, memory) for germs,
+        where genome is a Genome and memory a dict of non-zero register values
+    """
+
+    return {'history':tank.get_history(),
+            'objects':[capture_object(obj) for obj in tank.objects.values()]}
+
+def capture_object(obj):
+    """Returns (tuple): The record of a single germ or food particle, as in capture"""
+
+    if obj.brain:
+        return (obj.id, obj.alive, obj.x, obj.y, obj.energy, obj.stamina, obj.success,
+                obj.burst, obj.pain, obj.brain.genome, dict(obj.brain.memory))
+    return (obj.id, obj.alive, obj.x, obj.y)
+
+def encode(captured, memory_size):
+    """Serializes the result of capture to snapshot bytes.
+
+    Params:
+     - captured (dict): As returned by capture. A germ's genome or memory may be None, meaning
+        it is unchanged from some earlier snapshot.
+     - memory_size (int): Number of memory registers each germ has
+    """
+
+    columns = {name:array(typecode) for name, typecode in SECTIONS if typecode}
+    genome_index = {}
+    genome_codes = []
+    big_values = []
+    for obj in captured['objects']:
+        columns['ids'].append(obj[0])
+        columns['xs'].append(obj[2])
+        columns['ys'].append(obj[3])
+        flags = ALIVE if obj[1] else 0
+        if len(obj) == 4:
+            columns['flags'].append(flags | FOOD)
+            continue
+        obj_id, alive, x, y, energy, stamina, success, burst, pain, genome, memory = obj
+        columns['flags'].append(flags | (SUCCESS if success else 0) | (BURST if burst else 0))
+        columns['energy'].append(energy)
+        columns['stamina'].append(stamina)
+        columns['pain'].append(pain)
+        if genome is None:
+            columns['genomes'].append(KEEP_GENOME)
+        else:
+            if genome not in genome_index:
+                genome_index[genome] = len(genome_codes)
+                genome_codes.append(genome.code)
+            columns['genomes'].append(genome_index[genome])
+        if memory is None:
+            columns['memory_counts'].append(KEEP_MEMORY)
+            continue
+        pairs = sorted((i, v) for i, v in memory.items() if v)
+        columns['memory_counts'].append(len(pairs))
+        for register, value in pairs:
+            columns['registers'].append(register)
+            if BIG_VALUE < value < -BIG_VALUE:
+                columns['values'].append(value)
+            else:
+                columns['values'].append(BIG_VALUE)
+                big_values.append(value)
+
+    blob = bytearray()
+    for code in genome_codes:
+        columns['genome_offsets'].append(len(blob))
+        blob += json.dumps(code, separators=(',', ':')).encode()
+    columns['genome_offsets'].append(len(blob))
+
+    history = dict(captured['history'])
+    frames_elapsed = history.pop('frames_elapsed')
+    next_id = history.pop('next_id')
+    data = {'genome_blob':bytes(blob),
+            'big_values':json.dumps(big_values).encode(),
+            'history':json.dumps(history).encode()}
+    for name, column in columns.items():
+        if sys.byteorder == 'big':
+            column.byteswap()
+        data[name] = column.tobytes()
+
+    out = bytearray(HEADER.pack(MAGIC, VERSION, 0, frames_elapsed, next_id,
+                                len(columns['ids']), len(columns['energy']), len(genome_codes),
+                                memory_size, len(SECTIONS)))
+    offset = align(len(out) + SECTION.size * len(SECTIONS))
+    for name, typecode in SECTIONS:
+        out += SECTION.pack(offset, len(data[name]))
+        offset = align(offset + len(data[name]))
+    for name, typecode in SECTIONS:
+        out += bytes(align(len(out)) - len(out))
+        out += data[name]
+    return bytes(out)
+
+def decode(buffer):
+    """Reads snapshot bytes back into the form returned by capture.
+
+    Params:
+     - buffer (bytes-like): The snapshot, e.g. bytes read from a file or an mmap of one
+
+    Returns (dict): Keys are:
+     - history (dict): frames_elapsed, next_id and any other tank history
+     - memory_size (int): Number of memory registers each germ has
+     - objects (list of tuple): As returned by capture, except that each germ's genome is its
+        code (one list shared by all germs with that genome) rather than a Genome
+    """
+
+    view = memoryview(buffer)
+    if len(view) < HEADER.size:
+        raise ValueError('Snapshot is truncated')
+    (magic, version, flags, frames_elapsed, next_id, object_count, germ_count, genome_count,
+     memory_size, section_count) = HEADER.unpack_from(view)
+    if magic != MAGIC:
+        raise ValueError('Not a tank snapshot')
+    if version != VERSION:
+        raise ValueError(f'Unsupported snapshot version {version}')
+
+    sections = {}
+    for i, (name, typecode) in enumerate(SECTIONS):
+        offset, length = SECTION.unpack_from(view, HEADER.size + SECTION.size * i)
+        if offset + length > len(view):
+            raise ValueError('Snapshot is truncated')
+        data = bytes(view[offset:offset + length])
+        if typecode:
+            data = array(typecode, data)
+            if sys.byteorder == 'big':
+                data.byteswap()
+        sections[name] = data
+    offsets = sections['genome_offsets']
+    blob = sections['genome_blob']
+    genomes = [json.loads(blob[offsets[i]:offsets[i + 1]]) for i in range(genome_count)]
+    big_values = iter(json.loads(sections['big_values']))
+
+    objects = []
+    germ_index = 0
+    pair_index = 0
+    for obj_id, x, y, flags in zip(sections['ids'], sections['xs'], sections['ys'],
+                                   sections['flags']):
+        alive = bool(flags & ALIVE)
+        if flags & FOOD:
+            objects.append((obj_id, alive, x, y))
+            continue
+        count = sections['memory_counts'][germ_index]
+        if count == KEEP_MEMORY:
+            memory = None
+        else:
+            memory = {}
+            for i in range(pair_index, pair_index + count):
+                value = sections['values'][i]
+                memory[sections['registers'][i]] = (next(big_values) if value == BIG_VALUE
+                                                    else value)
+            pair_index += count
+        genome = sections['genomes'][germ_index]
+        objects.append((obj_id, alive, x, y, sections['energy'][germ_index],
+                        sections['stamina'][germ_index], bool(flags & SUCCESS),
+                        bool(flags & BURST), sections['pain'][germ_index],
+                        None if genome == KEEP_GENOME else genomes[genome], memory))
+        germ_index += 1
+
+    history = json.loads(sections['history'])
+    history['frames_elapsed'] = frames_elapsed
+    history['next_id'] = next_id
+    return {'history':history, 'memory_size':memory_size, 'objects':objects}
+
+def align(offset):
+    """Rounds offset up to a multiple of 8"""
+
+    return (offset + 7) & ~7
+
+if __name__ == '__main__':
+    # convert between snapshot and json saves, e.g. tank_snapshot.py autosave.tank autosave.json
+    from germ_tank import GermTank
+    if len(sys.argv) != 3:
+        sys.exit(f'Usage: {sys.argv[0]} SOURCE DEST (json files must end in .json)')
+    if sys.argv[1].endswith('.json'):
+        with open(sys.argv[1]) as fileobj:
+            tank = GermTank(fileobj.read())
+    else:
+        with open(sys.argv[1], 'rb') as fileobj:
+            tank = GermTank(snapshot=fileobj.read())
+    if sys.argv[2].endswith('.json'):
+        with open(sys.argv[2], 'w') as fileobj:
+            fileobj.write(tank.to_json())
+    else:
+        with open(sys.argv[2], 'wb') as fileobj:
+            fileobj.write(tank.to_snapshot())
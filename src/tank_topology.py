@@ -0,0 +1,57 @@
+"""Precomputed neighbourhoods of the cells of a tank"""
+
+from functools import lru_cache
+
+# relative coordinates of the 3x3 block of cells around a cell, including the cell itself;
+# germ code can only ask for actions on these, as its ax and ay are each -1, 0 or 1
+NEIGHBOURHOOD = [(dx, dy) for dx in [-1, 0, 1] for dy in [-1, 0, 1]]
+CENTRE = NEIGHBOURHOOD.index((0, 0))
+# positions in NEIGHBOURHOOD of the 8 cells adjacent to a cell
+ADJACENT = [n for n in range(len(NEIGHBOURHOOD)) if n != CENTRE]
+# BIRTH_ORDERS[n] lists the positions in ADJACENT by Manhattan distance from NEIGHBOURHOOD[n],
+# nearest first, which is the order a germ asking to give birth there tries them in
+BIRTH_ORDERS = [tuple(sorted(ADJACENT, key=lambda a: abs(dx - NEIGHBOURHOOD[a][0])
+                                                     + abs(dy - NEIGHBOURHOOD[a][1])))
+                for dx, dy in NEIGHBOURHOOD]
+
+class TankTopology:
+    """The flat grid indices of every cell's neighbourhood in a tank of a given shape.
+
+    Looking a neighbour up here replaces working out its coordinates, wrapping them and
+    checking them against the edges of the tank each time.
+    """
+
+    def __init__(self, width, height, wrap):
+        """Class constructor.
+
+        Params:
+         - width (int): Width of the tank
+         - height (int): Height of the tank
+         - wrap (bool): Whether the left and right edges of the tank meet
+        """
+
+        self.width = width
+        self.height = height
+        self.wrap = wrap
+        # sharing one int object per cell keeps the tables to a few bytes per neighbour
+        cells = list(range(width * height))
+        cols = [x % width if wrap or 0 <= x < width else -1 for x in range(-1, width + 1)]
+        rows = [y * width if 0 <= y < height else -1 for y in range(-1, height + 1)]
+        # neighbours[i][n] is the index of the cell at NEIGHBOURHOOD[n] from cell i, or -1 if
+        # that's off the tank
+        self.neighbours = [
+            tuple(cells[rows[y + dy + 1] + cols[x + dx + 1]]
+                  if rows[y + dy + 1] != -1 and cols[x + dx + 1] != -1 else -1
+                  for dx, dy in NEIGHBOURHOOD)
+            for y in range(height) for x in range(width)]
+
+def direction(dx, dy):
+    """Returns (int): The position of (dx, dy) in NEIGHBOURHOOD; each must be -1, 0 or 1"""
+
+    return (dx + 1) * 3 + dy + 1
+
+@lru_cache
+def get_topology(width, height, wrap):
+    """Returns the TankTopology for a tank of this shape, shared by every tank of that shape"""
+
+    return TankTopology(width, height, wrap)